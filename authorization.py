@@ -3,14 +3,14 @@
 Переходим на страницу авторизации, проходим ее, получаем cookies для дальнейшего использования
 Логин и пароль подставляются в форму авторизации автоматически
 Вручную необходимо решить recaptcha в течении 60 секунд и авторизоваться
+selenium импортируется только при запуске браузера, поэтому запуск по сохраненным Cookies его не загружает
 """
 import os
+import threading
 import time
 import random
 
 from loguru import logger
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
 
 from settings.settings import URL_SHOP, USERNAME, PASSWORD
 
@@ -24,6 +24,7 @@ def close_browser(browser):
 
 # функция проверяет по xpath существует ли элемент на странице
 def xpath_exists(browser, path):
+    from selenium.common.exceptions import NoSuchElementException
     try:
         browser.find_element_by_xpath(path)
         return True
@@ -35,6 +36,8 @@ def get_cookies():
     """
     :return: Список словарей с именами и значениями cookies после авторизации на сайте
     """
+    from selenium import webdriver
+    from selenium.common.exceptions import NoSuchElementException
     options = webdriver.ChromeOptions()
     # отключение режима Webdriver
     # for ChromeDriver version 79.0.3945.16 or over
@@ -90,9 +93,9 @@ def get_cookies():
         return cookies
 
 
-def get_response_selenium(url, session):
-    # получение html-страницы для разбора
-    logger.info(f'Открываем браузер в скрытом режиме и переходим на сайт {url}')
+def _create_headless_browser():
+    # браузер в скрытом режиме для получения страниц
+    from selenium import webdriver
     options = webdriver.ChromeOptions()
     # запуск браузера в скрытом режиме
     options.add_argument('--headless')
@@ -102,10 +105,10 @@ def get_response_selenium(url, session):
         f'--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
         f' Chrome/87.0.4280.88 Safari/537.36')
     driver_file = os.getcwd() + f'\\chromedriver\\chromedriver.exe'  # path to ChromeDriver
-    browser = webdriver.Chrome(driver_file, options=options)
+    return webdriver.Chrome(driver_file, options=options)
 
-    browser.get(url=url)  # открываем страницу с товаром
 
+def _add_session_cookies(browser, session):
     # достаем cookies из текущей сессии и добавляем в браузер
     for cookie in session.cookies:
         browser.add_cookie(
@@ -118,8 +121,16 @@ def get_response_selenium(url, session):
             }
         )
 
+
+def get_response_selenium(url, session):
+    # получение html-страницы для разбора
+    # браузер запускается на один запрос, для частых запросов используется BrowserPool
+    logger.info(f'Открываем браузер в скрытом режиме и переходим на сайт {url}')
+    browser = _create_headless_browser()
+
+    browser.get(url=url)  # открываем страницу с товаром
+    _add_session_cookies(browser, session)
     browser.refresh()  # обновляем страницу
-    print('после обновления страницы')
     response_selenium = browser.page_source
 
     # для отладки
@@ -133,6 +144,108 @@ def get_response_selenium(url, session):
     return response_selenium
 
 
+class BrowserPool:
+    """
+    Пул долгоживущих браузеров в скрытом режиме для страниц, которые не удалось получить через requests.
+    Браузеры запускаются по мере необходимости, не больше size. Cookies сессии добавляются в браузер
+    один раз при запуске, дальше браузер только открывает страницы. Браузер перезапускается
+    после max_pages страниц или если память процессов браузера (RSS chromedriver и всех процессов Chrome,
+    запущенных им) превысила max_memory байт. Память считается через psutil, без него браузер
+    перезапускается только по max_pages
+    """
+
+    def __init__(self, session, size=2, max_pages=100, max_memory=500 * 1024 * 1024):
+        self.session = session  # сессия requests с Cookies авторизации
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self._idle = []  # свободные браузеры [браузер, кол-во открытых страниц]
+        self._started = 0  # кол-во запущенных браузеров
+        self._condition = threading.Condition()
+        self.recycled = 0  # кол-во перезапусков браузеров
+
+    def _start(self):
+        logger.info(f'Запускаем браузер пула в скрытом режиме')
+        browser = _create_headless_browser()
+        browser.get(URL_SHOP)  # Cookies добавляются только для открытого в браузере домена
+        _add_session_cookies(browser, self.session)
+        return [browser, 0]
+
+    def _lease(self):
+        # свободный браузер, новый браузер, если пул не заполнен, или ожидание освобождения браузера
+        with self._condition:
+            while not self._idle and self._started >= self.size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return self._start()
+        except Exception:
+            with self._condition:
+                self._started -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, lease, broken=False):
+        browser, pages = lease
+        if not broken and pages < self.max_pages and self._memory(browser) < self.max_memory:
+            with self._condition:
+                self._idle.append(lease)
+                self._condition.notify()
+            return
+        logger.debug(f'Перезапуск браузера пула после {pages} страниц')
+        try:
+            close_browser(browser)
+        except Exception as ex:
+            logger.debug(f'Ошибка закрытия браузера {ex}')
+        with self._condition:
+            self._started -= 1
+            self.recycled += 1
+            self._condition.notify()  # ожидающий поток запустит новый браузер
+
+    @staticmethod
+    def _memory(browser):
+        # RSS процессов браузера, байт, 0 если psutil не установлен или процесс уже завершен
+        try:
+            import psutil  # необязательная зависимость, нужна только для перезапуска браузеров по памяти
+        except ImportError:
+            return 0
+        try:
+            driver = psutil.Process(browser.service.process.pid)
+            return sum(process.memory_info().rss for process in [driver] + driver.children(recursive=True))
+        except Exception:
+            return 0
+
+    def get(self, url):
+        """
+        html-код страницы, открытой в браузере пула
+        :return: текст страницы или None, если страница не открылась
+        """
+        lease = self._lease()
+        try:
+            lease[0].get(url)
+            lease[1] += 1
+            text = lease[0].page_source
+        except Exception as ex:
+            logger.error(f'Ошибка открытия страницы в браузере {ex}')
+            self._release(lease, broken=True)
+            return None
+        self._release(lease)
+        return text
+
+    def close(self):
+        # закрываем свободные браузеры, вызывается после завершения парсинга
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+        for browser, pages in idle:
+            try:
+                close_browser(browser)
+            except Exception as ex:
+                logger.debug(f'Ошибка закрытия браузера {ex}')
+
+
 if __name__ == '__main__':
     pass
     # print(get_cookies())
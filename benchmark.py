@@ -0,0 +1,96 @@
+"""
+Замер скорости разбора страниц товаров, страниц в секунду.
+Сравнивает прежнюю схему (страница разбирается BeautifulSoup дважды: для проверки авторизации
+и для парсинга, поля ищутся методом find) с текущей, где дерево lxml строится один раз в объекте Page,
+а поля извлекаются скомпилированными правилами из extractors.
+Запуск: python benchmark.py [путь к сохраненной html-странице товара] [кол-во повторов]
+Без файла используется синтетическая страница с большим описанием.
+Дополнительно замеряется разбор в пуле процессов parsepool с PARSER_WORKERS процессами
+"""
+import os
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup
+
+from extractors import extract
+from page import Page
+from parsepool import ParserPool
+
+PARSER_WORKERS = os.cpu_count() or 1
+
+SYNTHETIC_PAGE = '''<html><head><title>Listing</title>{scripts}</head><body>
+<form action="/Members/Logout.aspx"><button>Log out</button></form>
+<h1>Synthetic listing</h1>
+<div id="ListingContentBoxdescription">{description}</div>
+<div id="BuyNow_BuyNow">$1,234.50</div>
+<span class="tm-buy-now-box__label">Buy Now</span>
+</body></html>'''
+
+
+def synthetic_page(paragraphs=2000):
+    description = ''.join(f'<p>Строка описания товара номер {i}</p>' for i in range(paragraphs))
+    scripts = ''.join(f'<script>var widget{i} = {{"buyNowPrice": 1234.50}};</script>' for i in range(200))
+    return SYNTHETIC_PAGE.format(description=description, scripts=scripts)
+
+
+def parse_twice(text):
+    # прежняя схема: отдельный разбор в _check_open_url и в parsing_products
+    soup = BeautifulSoup(text, 'lxml')
+    soup.find('form', action="/Members/Logout.aspx").text.strip()
+    soup = BeautifulSoup(text, 'lxml')
+    soup.find('h1').text.strip()
+    description = ''
+    for string in soup.find('div', id=re.compile(r'\w+ContentBoxdescription')).stripped_strings:
+        description += string + '\n'
+    soup.find('div', id='BuyNow_BuyNow').text
+    soup.find('span', class_='tm-buy-now-box__label').text
+
+
+def parse_once(text):
+    # текущая схема: одно дерево lxml в Page для авторизации и всех полей товара
+    page = Page('https://www.trademe.co.nz/Browse/Listing.aspx?id=1', text)
+    for name in ('login', 'title', 'description', 'price', 'price_tag'):
+        extract(name, page)
+
+
+def pool_pages_per_second(text, repeat, workers):
+    # разбор страниц товаров в пуле процессов из workers потоков загрузки, как в TrademeParserBot.parse_product
+    pool = ParserPool(workers)
+    page = Page('https://www.trademe.co.nz/Browse/Listing.aspx?id=1', text)
+    try:
+        pool.parse_product(page, '1')  # запуск процессов пула не учитывается в замере
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda _: pool.parse_product(page, '1'), range(repeat)))
+        return repeat / (time.perf_counter() - start)
+    finally:
+        pool.close()
+
+
+def pages_per_second(func, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return repeat / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r', encoding='utf-8') as file:
+            html = file.read()
+    else:
+        html = synthetic_page()
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    before = pages_per_second(parse_twice, html, count)
+    after = pages_per_second(parse_once, html, count)
+    print(f'Размер страницы {len(html) // 1024} КБ, повторов {count}')
+    print(f'До:    {before:.2f} стр/с (BeautifulSoup, два разбора страницы)')
+    print(f'После: {after:.2f} стр/с (lxml, один разбор и правила extractors)')
+    print(f'Ускорение x{after / before:.2f}')
+    pool = pool_pages_per_second(html, count, PARSER_WORKERS)
+    print(f'Пул процессов: {pool:.2f} стр/с ({PARSER_WORKERS} процесс(а/ов) разбора)')
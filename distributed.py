@@ -0,0 +1,241 @@
+"""
+Распределенный парсинг магазинов на нескольких компьютерах, у каждого свой внешний IP-адрес.
+Координатор получает список магазинов из Google-таблицы, открывает первую страницу листинга магазина,
+добавляет остальные страницы листинга и затем ссылки на товары в очередь задач workqueue и записывает
+полученные от узлов строки товаров в Google-таблицу. Узлы арендуют задачи, открывают страницы
+методами TrademeParserBot и возвращают результат, у каждого узла свой бюджет запросов к сайту.
+Запуск:
+    python distributed.py coordinator [host:port]
+    python distributed.py worker [host:port]
+Без адреса координатор и узлы на одном компьютере используют общий файл очереди QUEUE_FILE,
+с адресом координатор открывает очередь узлам по TCP. Для узлов на других компьютерах в settings.py
+координатора и узлов задается один и тот же QUEUE_TOKEN, без него очередь доступна только с 127.0.0.1
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from extractors import last_listing_page, listing_page_url
+from googlesheetbot import GSheetsBot, SheetUploader
+from main import BATCH_INTERVAL, BATCH_SIZE, DELTA, RATE, REVALIDATE_AFTER, SNAPSHOT_FILE, WORKERS
+from main import COOKIES_FILE, authorized_parser, uploader_snapshot
+from ratelimit import HostRateLimiter
+from records import ProductRow
+from sessionstore import SessionStore
+from settings import settings
+from settings.settings import URL_SHOP
+from snapshot import SnapshotIndex
+from workqueue import DONE, FAILED, LEASED, LISTING, PENDING, PRODUCT, QueueClient, QueueServer, SqliteQueue
+
+QUEUE_FILE = '\\shops\\queue.db'  # очередь задач распределенного парсинга
+LEASE = 300  # время аренды задачи узлом, после него задача упавшего узла выдается снова, секунд
+POLL_INTERVAL = 2  # пауза опроса очереди при отсутствии задач или результатов, секунд
+STALL_TIMEOUT = 2 * LEASE  # сколько ждать без изменений в очереди магазина, прежде чем считать узлы остановленными
+QUEUE_TOKEN = getattr(settings, 'QUEUE_TOKEN', None)  # общий секрет координатора и узлов для очереди по TCP
+
+
+class Coordinator:
+    """Координатор распределенного парсинга: заполняет очередь задач и собирает результаты"""
+
+    def __init__(self, queue, parser, gsheet, snapshot=None, poll_interval=POLL_INTERVAL,
+                 stall_timeout=STALL_TIMEOUT):
+        self.queue = queue
+        self.parser = parser  # авторизованный бот для первой страницы листинга и режима delta
+        self.gsheet = gsheet
+        self.snapshot = snapshot
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+
+    def _wait(self, kind, name_shop, handle):
+        """
+        передает результаты задач в handle, пока в очереди есть невыполненные задачи магазина
+        :return: False, если очередь магазина не менялась stall_timeout секунд: узлы остановлены,
+                 например из-за потери авторизации
+        """
+        last_counts, last_change = None, time.monotonic()
+        while True:
+            results = self.queue.collect(kind, name_shop)
+            for url, count, result in results:
+                handle(url, count, result)
+            counts = self.queue.counts(kind, name_shop)
+            if not counts.get(PENDING) and not counts.get(LEASED) and not counts.get(DONE):
+                if counts.get(FAILED):
+                    logger.warning(f'Не выполнено задач {kind} магазина {name_shop}: {counts[FAILED]}')
+                return True
+            if results or counts != last_counts:
+                last_counts, last_change = counts, time.monotonic()
+            elif time.monotonic() - last_change > self.stall_timeout:
+                logger.error(f'Задачи {kind} магазина {name_shop} не выполняются {self.stall_timeout} секунд, '
+                             f'состояние очереди {counts}. Узлы остановлены или недоступны')
+                return False
+            if not results:
+                time.sleep(self.poll_interval)
+
+    def run_shop(self, shop):
+        """
+        Парсинг одного магазина узлами
+        :param shop: Список из Наименования магазина и ссылки на первую страницу листинга
+        :return: False, если авторизация на сайте потеряна или узлы перестали выполнять задачи
+        """
+        name_shop = shop[0].strip('\r')  # Наименование магазина
+        url_shop = shop[1]  # ссылка на листинг магазина
+        logger.info(f'Начинаем распределенный парсинг магазина "{name_shop}"')
+        self.queue.reset_shop(name_shop)
+
+        page = self.parser._check_open_url(url_shop)  # проверка авторизации на странице
+        if not page:
+            logger.warning(f'Из-за ошибки пропускаем парсинг листинга магазина "{name_shop}"')
+            return True
+        if page == 'STOP':
+            logger.error(f'Авторизация на первой странице листинга магазина "{name_shop}" не подтверждена')
+            return False
+
+        first_listing = page.url.replace(URL_SHOP, '') + '&type=&page=1'
+        known_pages = [last_listing_page(page)]
+        products = self.parser.get_urls_products(page, url_shop)
+        self.queue.put(LISTING, name_shop,
+                       {listing_page_url(first_listing, number): 1 for number in range(2, known_pages[0] + 1)})
+
+        def _listing_done(listing, count, result):
+            products.update(result['products'])
+            if result['last_page'] > known_pages[0]:  # пагинация показала новые страницы
+                self.queue.put(LISTING, name_shop, {listing_page_url(first_listing, number): 1
+                                                    for number in range(known_pages[0] + 1, result['last_page'] + 1)})
+                known_pages[0] = result['last_page']
+
+        if not self._wait(LISTING, name_shop, _listing_done):
+            return False
+        logger.success(f'Получено {len(products)} ссылки на товары в магазине "{name_shop}"')
+
+        self.parser.data_for_parsing[name_shop] = {'url-listing': [], 'products': dict(products)}
+        self.parser.count_changed = 0
+        due = dict(products)
+        if self.snapshot is not None:
+            due = self.parser._select_due_products(name_shop, due)
+        self.queue.put(PRODUCT, name_shop, due)
+
+        logger.info(f'Начинаем запись товаров в Google таблицу по магазину {name_shop} во время парсинга')
+        uploader = SheetUploader(self.gsheet, name_shop, batch_size=BATCH_SIZE, interval=BATCH_INTERVAL,
+                                 **uploader_snapshot(self.snapshot, name_shop))
+        try:
+            def _product_done(url_product, count, row):
+                row = ProductRow.make(row)  # строка из JSON очереди задач
+                # изменившиеся товары режима delta обновляются на листе пачками
+                if self.parser._is_new_row(name_shop, row, uploader.update):
+                    uploader.put(row)
+
+            done = self._wait(PRODUCT, name_shop, _product_done)
+        finally:
+            uploader.close()  # записываем последнюю пачку строк
+        self.parser.data_for_parsing = {}
+        return done
+
+
+class Worker:
+    """Узел распределенного парсинга: арендует задачи в очереди и выполняет их в parser.workers потоках"""
+
+    def __init__(self, queue, parser, owner=None, poll_interval=POLL_INTERVAL):
+        self.queue = queue
+        self.parser = parser
+        self.owner = owner or f'{socket.gethostname()}-{os.getpid()}'  # имя узла в аренде задач
+        self.poll_interval = poll_interval
+        self.stop = threading.Event()  # остановка узла, например при потере авторизации
+
+    def run(self):
+        logger.info(f'Узел {self.owner} ждет задачи, одновременных запросов {self.parser.workers}')
+        with ThreadPoolExecutor(max_workers=self.parser.workers) as executor:
+            for future in [executor.submit(self._loop) for _ in range(self.parser.workers)]:
+                future.result()
+
+    def _loop(self):
+        while not self.stop.is_set():
+            try:
+                tasks = self.queue.lease(self.owner, 1)
+            except Exception as ex:  # координатор перезапускается или база очереди занята
+                logger.error(f'Ошибка получения задачи из очереди {ex}')
+                time.sleep(self.poll_interval)
+                continue
+            if not tasks:
+                time.sleep(self.poll_interval)
+                continue
+            self._run_task(tasks[0])
+
+    def _run_task(self, task):
+        result = None
+        try:
+            if task['kind'] == LISTING:
+                page, products, last_page = self.parser.parse_listing(task['url'])
+                if page and page != 'STOP':
+                    result = {'products': dict(products), 'last_page': last_page}
+            else:
+                row = self.parser.parse_product(task['url'], task['count'])
+                if row and row != 'STOP':
+                    result = row
+        except Exception as ex:
+            logger.error(f'Ошибка выполнения задачи {task["url"]} {ex}')
+
+        try:
+            if result is not None:
+                if not self.queue.complete(task['id'], self.owner, result):
+                    logger.warning(f'Аренда задачи {task["url"]} истекла, результат не принят')
+                return
+            self.queue.release(task['id'], self.owner)  # задача будет выдана повторно
+        except Exception as ex:
+            # задача будет выдана повторно после окончания аренды
+            logger.error(f'Ошибка передачи результата задачи {task["url"]} в очередь {ex}')
+            time.sleep(self.poll_interval)
+        if self.parser.count_no_auth <= 0:
+            logger.error(f'Из-за ошибок авторизации узел {self.owner} прекращает работу')
+            self.stop.set()
+
+
+def _address(argv):
+    # адрес координатора host:port из аргументов командной строки или None
+    if len(argv) < 3:
+        return None
+    host, port = argv[2].rsplit(':', 1)
+    return host, int(port)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('coordinator', 'worker'):
+        print('Запуск: python distributed.py coordinator|worker [host:port]')
+        sys.exit(2)
+    role, address = sys.argv[1], _address(sys.argv)
+
+    path_log = os.getcwd() + f'\\logs\\{role}.log'
+    logger.add(path_log, level='DEBUG', compression="zip", rotation="9:00", retention="3 days", encoding='utf-8')
+
+    snapshot = None
+    if DELTA and role == 'coordinator':
+        snapshot = SnapshotIndex(os.getcwd() + SNAPSHOT_FILE, revalidate_after=REVALIDATE_AFTER)
+    # Cookies прошлого запуска узла, браузер для авторизации открывается, только если они не действуют
+    parser = authorized_parser(SessionStore(os.getcwd() + COOKIES_FILE), workers=WORKERS,
+                               rate_limiter=HostRateLimiter(rate=RATE), snapshot=snapshot)
+    if parser is None:
+        logger.error(f'Работа скрипта завершена из-за ошибки авторизации')
+        sys.exit(1)
+
+    if role == 'worker':
+        if address:
+            queue = QueueClient(address, token=QUEUE_TOKEN)
+        else:
+            queue = SqliteQueue(os.getcwd() + QUEUE_FILE, lease=LEASE)
+        Worker(queue, parser).run()
+        sys.exit(1)  # узел останавливается только при потере авторизации
+
+    queue = SqliteQueue(os.getcwd() + QUEUE_FILE, lease=LEASE)
+    if address:
+        QueueServer(queue, address, token=QUEUE_TOKEN).start()
+    gsheet = GSheetsBot()
+    coordinator = Coordinator(queue, parser, gsheet, snapshot=snapshot)
+    for shop in gsheet.shops:
+        if not coordinator.run_shop(shop):
+            logger.error(f'Необходимо проверить узлы или заново запустить скрипт и пройти процедуру авторизации')
+            sys.exit(1)
+    logger.success(f'Распределенный парсинг магазинов завершен')
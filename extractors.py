@@ -0,0 +1,407 @@
+"""
+Реестр правил извлечения полей товара со страниц сайта.
+Для каждого поля перечислены варианты (правила) под разную структуру html-страниц:
+заранее скомпилированные XPath-выражения по дереву lxml или регулярные выражения по html-тексту.
+Поле запоминает, сколько раз сработало каждое правило, и периодически переставляет правила так,
+чтобы первым проверялся вариант самой частой структуры страницы.
+Новая структура страницы добавляется одним правилом в FIELDS.
+Если на странице есть встроенный JSON со состоянием страницы (frend-state), вся строка товара
+берется из него одним json.loads без построения дерева, правила FIELDS нужны только для недостающих полей
+"""
+import html
+import json
+import re
+import threading
+
+from collections import Counter
+from loguru import logger
+from lxml import etree
+
+PRICE_NUMBER = re.compile(r'\d+.\d+')  # число в тексте цены после удаления запятых
+# ссылка на товар в любом виде: /Browse/Listing.aspx?id=<id>, /a/.../listing/<id>?bof=..., .../listing-<id>.htm
+PRODUCT_HREF = re.compile(r'Listing\.aspx\?id=(\d+)|/listing/(\d+)|/listing-(\d+)\.htm', re.I)
+PRODUCT_URL = '/Browse/Listing.aspx?id={}'  # единый вид ссылки на товар
+LISTING_HREF = re.compile(r'Feedback\.aspx\?member=\d+&type=&page=\d+')  # ссылка на страницу листинга
+LISTING_PAGE = re.compile(r'&page=(\d+)')  # номер страницы в ссылке на страницу листинга
+
+TAG = re.compile(r'<[^>]+>')
+# встроенный JSON со состоянием страницы товара
+STATE_SCRIPT = re.compile(r'<script[^>]*id="frend-state"[^>]*>(.*?)</script>', re.S)
+# экранирование Angular TransferState внутри встроенного JSON
+STATE_ESCAPE = re.compile(r'&(q|s|l|g|a);')
+STATE_UNESCAPE = {'q': '"', 's': "'", 'l': '<', 'g': '>', 'a': '&'}
+# ключи полей товара в объекте листинга встроенного JSON, по порядку предпочтения
+STATE_KEYS = {
+    'title': ('title',),
+    'description': ('body',),
+    'price': ('buyNowPrice',),
+    'price_tag': ('buyNowPriceLabel', 'priceLabel'),
+}
+
+_EXSLT = {'re': 'http://exslt.org/regular-expressions'}
+
+
+def has_class(name):
+    # условие XPath, аналогичное поиску BeautifulSoup по одному из классов тега
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def element_text(element):
+    # аналог .text.strip() у тега BeautifulSoup
+    return element.text_content().strip()
+
+
+def element_strings(element):
+    # аналог перебора stripped_strings: каждая непустая строка текста с новой строки
+    strings = [string.strip() for string in element.itertext() if string.strip()]
+    return '\n'.join(strings) + '\n' if strings else ''
+
+
+def match_text(match):
+    # текст первой группы регулярного выражения без тегов, аналог .text.strip()
+    return html.unescape(TAG.sub('', match.group(1))).strip()
+
+
+def price_from_text(text):
+    # цена из текста вида "$1,234.50", None если числа нет
+    match = PRICE_NUMBER.search(text.replace(',', ''))
+    return float(match.group(0)) if match else None
+
+
+class XPathRule:
+    """Правило извлечения по дереву lxml, возвращает значение из первого найденного узла"""
+
+    def __init__(self, name, path, convert=element_text, namespaces=None):
+        self.name = name
+        self.path = path
+        self._xpath = etree.XPath(path, namespaces=namespaces)
+        self.convert = convert
+
+    def apply(self, page):
+        nodes = self._xpath(page.tree)
+        if not nodes:
+            return None
+        return self.convert(nodes[0])
+
+
+class RegexRule:
+    """Правило извлечения регулярным выражением по html-тексту страницы, дерево не используется"""
+
+    def __init__(self, name, pattern, convert=lambda match: match.group(0), flags=0):
+        self.name = name
+        self.pattern = pattern
+        self._regex = re.compile(pattern, flags)
+        self.convert = convert
+
+    def apply(self, page):
+        match = self._regex.search(page.text)
+        if match is None:
+            return None
+        return self.convert(match)
+
+
+class Field:
+    """
+    Поле товара со списком правил извлечения.
+    Правила проверяются по порядку до первого результата, отличного от None.
+    Каждые reorder_every извлечений правила сортируются по числу срабатываний
+    """
+
+    def __init__(self, name, rules, default, reorder_every=50):
+        self.name = name
+        self.rules = list(rules)
+        self.default = default  # значение, если ни одно правило не сработало
+        self.reorder_every = reorder_every
+        self.hits = {rule.name: 0 for rule in self.rules}
+        self.misses = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def extract(self, page):
+        value, rule_name = self.apply(page)
+        self.count(rule_name)
+        return value
+
+    def apply(self, page):
+        """Значение поля и имя сработавшего правила (None - ни одно не сработало) без учета в статистике"""
+        for rule in self.rules:  # список правил заменяется целиком, поэтому перебор безопасен из потоков
+            value = rule.apply(page)
+            if value is not None:
+                return value, rule.name
+        return self.default, None
+
+    def count(self, rule_name):
+        # учет срабатывания правила rule_name или промаха (None), каждые reorder_every срабатываний
+        # правила сортируются по числу срабатываний
+        with self._lock:
+            if rule_name is None:
+                self.misses += 1
+                return
+            self.hits[rule_name] += 1
+            self._count += 1
+            if self._count % self.reorder_every == 0:
+                self.rules = sorted(self.rules, key=lambda item: self.hits[item.name], reverse=True)
+
+    def order(self):
+        """Имена правил в текущем порядке проверки"""
+        return [rule.name for rule in self.rules]
+
+    def set_order(self, names):
+        # порядок правил, полученный из другого процесса
+        if names != self.order():
+            position = {name: index for index, name in enumerate(names)}
+            self.rules = sorted(self.rules, key=lambda rule: position.get(rule.name, len(position)))
+
+    def stats(self):
+        """Доля срабатываний каждого правила в текущем порядке проверки"""
+        total = sum(self.hits.values()) + self.misses
+        return {rule.name: round(self.hits[rule.name] / total, 3) if total else 0 for rule in self.rules}
+
+
+FIELDS = {
+    # признаки авторизации на странице
+    # варианты регулярных выражений позволяют проверить авторизацию без построения дерева
+    'login': Field('login', [
+        RegexRule('logout-form-text', r'<form[^>]*action="/Members/Logout\.aspx"[^>]*>(.*?)</form>',
+                  convert=match_text, flags=re.S),
+        XPathRule('logout-form', "//form[@action='/Members/Logout.aspx']"),
+    ], default=None),
+    'logout': Field('logout', [
+        RegexRule('logout-link-text', r'<a[^>]*class="[^"]*\blogged-in__log-out\b[^"]*"[^>]*>(.*?)</a>',
+                  convert=match_text, flags=re.S),
+        XPathRule('logout-link', f"//a[{has_class('logged-in__log-out')}]"),
+    ], default=None),
+    # поля товара
+    'title': Field('title', [
+        XPathRule('h1', '//h1'),
+    ], default=''),
+    'description': Field('description', [
+        XPathRule('content-box', r"//div[re:test(@id, '\w+ContentBoxdescription')]",
+                  convert=element_strings, namespaces=_EXSLT),
+        XPathRule('markdown', f"//div[{has_class('tm-markdown')}]", convert=element_strings),
+    ], default=''),
+    'price': Field('price', [
+        XPathRule('buy-now', "//div[@id='BuyNow_BuyNow']", convert=lambda node: price_from_text(element_text(node))),
+        XPathRule('buy-now-box', "//p[@class='tm-buy-now-box__price p-h1']",
+                  convert=lambda node: price_from_text(element_text(node))),
+        # цена из dict в html, даже если цена скрыта
+        RegexRule('state-buy-now-price', r'"buyNowPrice": (\d+.\d+)', convert=lambda match: float(match.group(1))),
+    ], default=0),
+    'price_tag': Field('price_tag', [
+        XPathRule('buy-now-label', f"//span[{has_class('tm-buy-now-box__label')}]",
+                  convert=lambda node: node.text_content()),
+    ], default=''),
+}
+
+_HREFS = etree.XPath('//a/@href')
+
+
+def extract(name, page):
+    """Значение поля name со страницы page по правилам из FIELDS"""
+    return FIELDS[name].extract(page)
+
+
+def product_links(page):
+    """Все ссылки на товары на странице листинга, ссылки разного вида приводятся canonical_product_url"""
+    return [str(href) for href in _HREFS(page.tree) if PRODUCT_HREF.search(href)]
+
+
+def product_id(url):
+    """Номер листинга в ссылке на товар любого вида или None"""
+    match = PRODUCT_HREF.search(url)
+    if match is None:
+        return None
+    return next(group for group in match.groups() if group)
+
+
+def canonical_product_url(url):
+    """Ссылка на товар в едином виде /Browse/Listing.aspx?id=<id>, ссылка без номера листинга не меняется"""
+    number = product_id(url)
+    return PRODUCT_URL.format(number) if number is not None else url
+
+
+def listing_links(page):
+    """Все ссылки на страницы листинга магазина"""
+    return [str(href) for href in _HREFS(page.tree) if LISTING_HREF.search(href)]
+
+
+def listing_page_number(url):
+    """Номер страницы листинга в ссылке, 1 для ссылки без номера"""
+    match = LISTING_PAGE.search(url)
+    return int(match.group(1)) if match else 1
+
+
+def listing_page_url(url, number):
+    """Ссылка на страницу листинга number по ссылке на любую страницу листинга магазина"""
+    return LISTING_PAGE.sub(f'&page={number}', url)
+
+
+def last_listing_page(page):
+    """Наибольший номер страницы листинга среди ссылок на странице, 1 если ссылок нет"""
+    return max((listing_page_number(href) for href in listing_links(page)), default=1)
+
+
+PRODUCT_FIELDS = ('title', 'description', 'price', 'price_tag')
+PATHS = Counter()  # сколько раз строка товара получена из JSON ('state'), частично ('mixed') или по дереву ('dom')
+_paths_lock = threading.Lock()
+
+
+def decode_state(text):
+    """Встроенный JSON состояния страницы в виде dict или None, если его нет на странице"""
+    match = STATE_SCRIPT.search(text)
+    if match is None:
+        return None
+    return decode_state_script(match.group(1))
+
+
+def decode_state_script(blob):
+    """Встроенный JSON состояния из текста тега script или None"""
+    blob = STATE_ESCAPE.sub(lambda escape: STATE_UNESCAPE[escape.group(1)], blob)
+    try:
+        return json.loads(blob)
+    except ValueError:
+        return None
+
+
+def state_listing(state, listing_id):
+    """Объект листинга с номером listing_id во встроенном JSON (поиск в глубину)"""
+    stack = [state]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if str(item.get('listingId')) == listing_id and 'title' in item:
+                return item
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return None
+
+
+def _state_value(name, value):
+    # приведение значения из JSON к виду, который дают правила FIELDS
+    if name == 'description':
+        lines = [line.strip() for line in str(value).splitlines() if line.strip()]
+        return '\n'.join(lines) + '\n' if lines else ''
+    if name == 'price':
+        return float(value)
+    return str(value).strip()
+
+
+def extract_product(page, listing_id):
+    """
+    Поля товара title, description, price, price_tag со страницы.
+    Сначала из встроенного JSON (дерево страницы не строится), недостающие поля - правилами FIELDS
+    :return: dict полей товара
+    """
+    values, path, rules = product_fields(page, listing_id)
+    count_path(path, rules)
+    return values
+
+
+def count_path(path, rules=None):
+    """
+    учет способа получения строки товара в статистике PATHS и срабатываний правил полей
+    :param rules: dict поле - имя сработавшего правила или None, как возвращает product_fields
+    """
+    with _paths_lock:
+        PATHS[path] += 1
+    for name, rule_name in (rules or {}).items():
+        FIELDS[name].count(rule_name)
+
+
+def rule_order():
+    """Порядок правил полей товара для передачи в процессы parsepool"""
+    return {name: FIELDS[name].order() for name in PRODUCT_FIELDS}
+
+
+def set_rule_order(order):
+    # порядок правил полей товара из основного процесса
+    for name, names in order.items():
+        FIELDS[name].set_order(names)
+
+
+def product_fields(page, listing_id):
+    """
+    Поля товара без учета в статистике, используется и в процессах parsepool
+    :return: (dict полей товара, способ получения строки 'state', 'mixed' или 'dom',
+              dict поле - имя сработавшего правила FIELDS или None для полей, извлеченных правилами)
+    """
+    values = {}
+    rules = {}
+    listing = state_listing(page.state, listing_id) if page.state is not None else None
+    if listing is not None:
+        for name in PRODUCT_FIELDS:
+            for key in STATE_KEYS[name]:
+                if listing.get(key) is not None:
+                    values[name] = _state_value(name, listing[key])
+                    break
+        if 'price' not in values:  # в листинге без Buy Now нет цены и признака цены
+            values['price'] = FIELDS['price'].default
+            values.setdefault('price_tag', FIELDS['price_tag'].default)
+
+    if not values:
+        path = 'dom'
+    elif len(values) < len(PRODUCT_FIELDS):
+        path = 'mixed'
+    else:
+        path = 'state'
+
+    for name in PRODUCT_FIELDS:
+        if name not in values:
+            values[name], rules[name] = FIELDS[name].apply(page)
+            if values[name] == FIELDS[name].default:
+                logger.info(f'Ни один из вариантов парсинга {name} не найден')
+    return values, path, rules
+
+
+# поля, после получения которых потоковая загрузка страницы товара останавливается
+STREAM_FIELDS = frozenset(('login',) + PRODUCT_FIELDS)
+DESCRIPTION_ID = re.compile(r'\w+ContentBoxdescription')
+
+
+def _element_has_class(element, name):
+    return name in (element.get('class') or '').split()
+
+
+def stream_marker(listing_id):
+    """
+    Функция для потоковой загрузки страницы товара: по закончившемуся элементу дерева возвращает
+    множество полей из STREAM_FIELDS, которые уже можно извлечь правилами FIELDS или из встроенного JSON
+    """
+    def marker(element):
+        tag = element.tag
+        if tag == 'form' and element.get('action') == '/Members/Logout.aspx':
+            return {'login'}
+        if tag == 'a' and _element_has_class(element, 'logged-in__log-out'):
+            return {'login'}
+        if tag == 'h1':
+            return {'title'}
+        if tag == 'div' and (DESCRIPTION_ID.search(element.get('id') or '')
+                             or _element_has_class(element, 'tm-markdown')):
+            return {'description'}
+        if (tag == 'div' and element.get('id') == 'BuyNow_BuyNow'
+                or tag == 'p' and _element_has_class(element, 'tm-buy-now-box__price')):
+            return {'price'}
+        if tag == 'span' and _element_has_class(element, 'tm-buy-now-box__label'):
+            return {'price_tag'}
+        if tag == 'script' and element.text:
+            if element.get('id') == 'frend-state':
+                # поля листинга из JSON, как в product_fields: без цены Buy Now цена и признак по умолчанию
+                state = decode_state_script(element.text)
+                listing = state_listing(state, listing_id) if state is not None else None
+                if listing is None:
+                    return None
+                fields = {name for name in PRODUCT_FIELDS
+                          if any(listing.get(key) is not None for key in STATE_KEYS[name])}
+                return fields if 'price' in fields else fields | {'price', 'price_tag'}
+            if '"buyNowPrice": ' in element.text:
+                return {'price'}
+        return None
+    return marker
+
+
+def extraction_stats():
+    """Статистика срабатывания правил по всем полям и доли способов получения строки товара"""
+    stats = {name: field.stats() for name, field in FIELDS.items()}
+    stats['paths'] = dict(PATHS)
+    return stats
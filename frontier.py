@@ -0,0 +1,85 @@
+"""
+Хранилище очереди парсинга (frontier) в SQLite в режиме WAL.
+Для каждой страницы листинга и ссылки на товар магазина хранится состояние pending/done/failed.
+Состояние записывается сразу при изменении одной короткой транзакцией, поэтому стоимость
+сохранения прогресса не зависит от размера магазина, а при аварийном завершении теряется
+не больше одной страницы. Режим допарсинга FILE_FOR_PARSING читает незавершенные ссылки отсюда
+"""
+import sqlite3
+import threading
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Frontier:
+    """Состояние страниц листинга и ссылок на товары по магазинам в файле SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')  # в режиме WAL без потери целостности
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS listing (
+                shop TEXT NOT NULL, url TEXT NOT NULL, state TEXT NOT NULL,
+                PRIMARY KEY (shop, url));
+            CREATE TABLE IF NOT EXISTS product (
+                shop TEXT NOT NULL, url TEXT NOT NULL, count INTEGER NOT NULL, state TEXT NOT NULL,
+                PRIMARY KEY (shop, url));
+        ''')
+        self._lock = threading.Lock()
+
+    def reset_shop(self, shop):
+        # новый парсинг магазина начинается с пустой очереди
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM listing WHERE shop = ?', (shop,))
+            self._connection.execute('DELETE FROM product WHERE shop = ?', (shop,))
+
+    def add_listing(self, shop, urls):
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO listing VALUES (?, ?, ?)',
+                                         [(shop, url, PENDING) for url in urls])
+
+    def complete_listing(self, shop, url, products):
+        """
+        Отмечает страницу листинга спарсенной и добавляет найденные на ней ссылки на товары
+        одной транзакцией, чтобы при повторном парсинге страницы товары не посчитались дважды
+        :param products: dict ссылка на товар - кол-во на странице
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO product VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (shop, url) DO UPDATE SET count = count + excluded.count',
+                [(shop, product, count, PENDING) for product, count in products.items()])
+            self._connection.execute('UPDATE listing SET state = ? WHERE shop = ? AND url = ?', (DONE, shop, url))
+
+    def set_listing_state(self, shop, url, state):
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE listing SET state = ? WHERE shop = ? AND url = ?', (state, shop, url))
+
+    def set_product_state(self, shop, url, state):
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE product SET state = ? WHERE shop = ? AND url = ?', (state, shop, url))
+
+    def load(self, shop):
+        """Незавершенные страницы листинга и ссылки на товары магазина в формате data_for_parsing"""
+        with self._lock:
+            listing = self._connection.execute(
+                'SELECT url FROM listing WHERE shop = ? AND state != ? ORDER BY rowid', (shop, DONE)).fetchall()
+            products = self._connection.execute(
+                'SELECT url, count FROM product WHERE shop = ? AND state != ? ORDER BY rowid', (shop, DONE)).fetchall()
+        return {'url-listing': [url for url, in listing], 'products': dict(products)}
+
+    def load_all(self):
+        """Все магазины с незавершенным парсингом в формате data_for_parsing"""
+        with self._lock:
+            shops = self._connection.execute(
+                'SELECT shop FROM listing WHERE state != ? UNION SELECT shop FROM product WHERE state != ?',
+                (DONE, DONE)).fetchall()
+        return {shop: self.load(shop) for shop, in shops}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
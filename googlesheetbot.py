@@ -1,22 +1,29 @@
 import csv
+import itertools
 import os
-import pygsheets
+import queue
+import threading
+import time
 
 from loguru import logger
 
+from metrics import METRICS
+from records import TITLE
 from settings.settings import SERVICE_ACCOUNT_FILE, SHEET_SHOPS, URL_GSHEET
 from settings.settings import START_ADDR, END_ADDR, ROW_START, ROW_END
 
+NUMBER_COLUMNS = (0, 1, 5)  # № Листинга, Кол-во и Цена записываются в таблицу числами
+
 
 class GSheetsBot:
     """
     Класс для работы с google-таблицей, содержащей ссылки на магазины.
     По результатам парсинга на каждый магазин создается отдельный лист.
-    Если лист с названием магазина существует, он будет удален перед загрузкой
-    данных результатов парсинга
+    Если лист с названием магазина существует, результаты парсинга дописываются в его конец
     """
 
     def __init__(self):
+        import pygsheets  # импортируется только при работе с таблицей, запуск скрипта от этого не замедляется
         try:
             self._path_api = os.getcwd() + SERVICE_ACCOUNT_FILE
             self.client = pygsheets.authorize(service_account_file=self._path_api)
@@ -27,42 +34,245 @@ class GSheetsBot:
         except Exception as ex:
             logger.error(f'Ошибка при открытии Google-таблицы {ex}')
             raise
+        # листы магазинов, записанные в текущем запуске, и кол-во заполненных строк на них
+        self._sheets_shops = {}
+        # магазины, файл csv которых создан в текущем запуске, следующие строки дописываются в его конец
+        self._csv_shops = set()
+        # магазины парсятся в нескольких потоках, запросы к таблице выполняются по одному
+        self._lock = threading.RLock()
+
+    def _get_sheet_shop(self, name_shop):
+        """
+        Лист магазина, кол-во заполненных строк на нем и признак того, что лист только что создан
+        Лист и кол-во строк запоминаются после первой записи, поэтому лист не скачивается повторно
+        """
+        if name_shop in self._sheets_shops:
+            sheet_shop, lastrow = self._sheets_shops[name_shop]
+            return sheet_shop, lastrow, False
+        from pygsheets.exceptions import WorksheetNotFound
+        try:  # если лист найден
+            sheet_shop = self.google_sheet.worksheet_by_title(name_shop)
+            logger.info(f'Лист магазина в Google таблице уже существует. Поэтому данные будут объединены')
+            # индекс последней непустой строки по первому столбцу, без скачивания описаний товаров
+            lastrow = len(sheet_shop.get_col(1, include_tailing_empty=False))
+            return sheet_shop, lastrow, False
+        except WorksheetNotFound:  # если лист не найден, создается новый
+            sheet_shop = self.google_sheet.add_worksheet(name_shop)
+            return sheet_shop, 0, True
+
+    @staticmethod
+    def _row_data(row):
+        # значения строки в формате RowData API Google Sheets, числовые столбцы записываются числами,
+        # как при прежней записи с USER_ENTERED, остальные столбцы - строками
+        def cell(column, value):
+            if column in NUMBER_COLUMNS and not isinstance(value, (int, float)):
+                try:
+                    value = int(value) if str(value).isdigit() else float(value)
+                except ValueError:  # заголовок таблицы или пустое значение
+                    pass
+            if isinstance(value, (int, float)):
+                return {'userEnteredValue': {'numberValue': value}}
+            return {'userEnteredValue': {'stringValue': str(value)}}
+        return {'values': [cell(column, value) for column, value in enumerate(row)]}
+
+    def _append_cells(self, sheet_id, rows):
+        # запрос дописывания строк в конец листа
+        return {'appendCells': {'sheetId': sheet_id, 'rows': [self._row_data(row) for row in rows],
+                                'fields': 'userEnteredValue'}}
+
+    def _column_widths(self, sheet_id):
+        # запросы ширины столбцов нового листа магазина
+        return [self._dimension_size(sheet_id, 'COLUMNS', 0, 7, 170),
+                self._dimension_size(sheet_id, 'COLUMNS', 4, 5, 500),
+                self._dimension_size(sheet_id, 'COLUMNS', 1, 2, 80)]
+
+    @staticmethod
+    def _dimension_size(sheet_id, dimension, start, end, pixel_size):
+        # запрос установки ширины столбцов или высоты строк, индексы с нуля, end не включается
+        return {'updateDimensionProperties': {
+            'range': {'sheetId': sheet_id, 'dimension': dimension, 'startIndex': start, 'endIndex': end},
+            'properties': {'pixelSize': pixel_size},
+            'fields': 'pixelSize'}}
 
     # метода сохранения результата парсинга в Google-таблицу
-    def save_result_parsing(self, name_shop: str, result: list):
+    # title=False используется для продолжения записи пачками, заголовок таблицы уже записан первой пачкой
+    # возвращает номер строки листа с первой записанной строкой товара или None, если запись не удалась
+    def save_result_parsing(self, name_shop: str, result: list, title=True):
+        with self._lock, METRICS.timer('sheets_write_seconds', shop=name_shop, op='append'):
+            METRICS.inc('sheets_rows_total', len(result), shop=name_shop, op='append')
+            return self._save_result_parsing(name_shop, result, title)
+
+    def _save_result_parsing(self, name_shop, result, title):
         if not result:
             logger.debug(f'Результат парсинга пустой список, сохранять в Google-таблицу нечего.')
-            return
-        title = ['№ Листинга', 'Кол-во', 'Ссылка на листинг',	'Товар', 'Описание', 'Цена', 'Признак цены']
-        result.insert(0, title)  # Добавляем заголовок таблицы
+            return None
+        # заголовок таблицы добавляется при записи, переданный список строк не копируется и не изменяется
+        header = [TITLE] if title else []
+        count = len(header) + len(result)
         try:
-            try:  # если лист найден
-                sheet_shop = self.google_sheet.worksheet_by_title(name_shop)
-                logger.info(f'Лист магазина в Google таблице уже существует. Поэтому данные будут объединены')
-                # получаем индекс последней непустой строки
-                lastrow = len(sheet_shop.get_all_values(include_tailing_empty_rows=False))
-                # дополняем Google-таблицу новыми значениями
-                sheet_shop.update_values(crange='A' + str(lastrow + 1), values=result, extend=True)
-                sheet_shop.adjust_column_width(start=1, end=7, pixel_size=170)  # установка ширины столбцов
-                sheet_shop.adjust_column_width(start=5, end=5, pixel_size=500)
-                sheet_shop.adjust_column_width(start=2, end=2, pixel_size=80)
-                # установка высоты строк
-                sheet_shop.adjust_row_height(start=lastrow + 2, end=lastrow + 2 + len(result), pixel_size=90)
-            except pygsheets.exceptions.WorksheetNotFound:  # если лист не найден, создается новый
-                sheet_shop = self.google_sheet.add_worksheet(name_shop)
-                # записываем значения в Google-таблицу
-                sheet_shop.update_values('A1', result, extend=True)
-                sheet_shop.adjust_column_width(start=1, end=7, pixel_size=170)  # установка ширины столбцов
-                sheet_shop.adjust_column_width(start=5, end=5, pixel_size=500)
-                sheet_shop.adjust_column_width(start=2, end=2, pixel_size=80)
-                sheet_shop.adjust_row_height(start=2, end=len(result), pixel_size=90)  # установка высоты строк
+            sheet_shop, lastrow, new_sheet = self._get_sheet_shop(name_shop)
+            # данные и оформление отправляются одним запросом batchUpdate: строки дописываются
+            # в конец листа (appendCells), лист целиком не скачивается
+            requests = [self._append_cells(sheet_shop.id, itertools.chain(header, result))]
+            if new_sheet:
+                requests.extend(self._column_widths(sheet_shop.id))
+            # высота новых строк товаров, строка заголовка не меняется
+            start = lastrow + 1 if title else lastrow
+            requests.append(self._dimension_size(sheet_shop.id, 'ROWS', start, lastrow + count, 90))
+            self.google_sheet.custom_request(requests, fields='spreadsheetId')
+            self._sheets_shops[name_shop] = [sheet_shop, lastrow + count]
+            return lastrow + 2 if title else lastrow + 1
         except Exception as ex:
             logger.error(f'Возникла ошибка при записи в Google-таблицу {ex}')
             logger.warning(f'Результат парсинга будет сохранен в файл {name_shop}.csv')
-            with open(os.getcwd() + f'\\csv\\{name_shop}.csv', "w", encoding='utf-8') as file_csv:
+            # файл прошлого запуска перезаписывается, продолжение записи пачками дописывается в конец файла
+            if name_shop in self._csv_shops:
+                mode, header = 'a', []
+            else:
+                mode, header = 'w', [TITLE]
+            with open(os.getcwd() + f'\\csv\\{name_shop}.csv', mode, encoding='utf-8') as file_csv:
                 file_writer = csv.writer(file_csv, delimiter=";", lineterminator="\r")
-                file_writer.writerows(result)
+                file_writer.writerows(itertools.chain(header, result))
+            self._csv_shops.add(name_shop)
             logger.success(f'Данные успешно сохранены в файл в папку csv')
+            return None
+
+    # метод обновления изменившихся строк товаров на листе магазина на месте
+    def update_rows(self, name_shop: str, rows: list):
+        """
+        :param rows: список (номер строки листа, строка товара)
+        :return: True, если строки обновлены на листе
+        """
+        if not rows:
+            return True
+        try:
+            with self._lock, METRICS.timer('sheets_write_seconds', shop=name_shop, op='update'):
+                sheet_shop, lastrow, new_sheet = self._get_sheet_shop(name_shop)
+                requests = self._column_widths(sheet_shop.id) if new_sheet else []
+                requests.extend({'updateCells': {'start': {'sheetId': sheet_shop.id, 'rowIndex': row_number - 1,
+                                                           'columnIndex': 0},
+                                                 'rows': [self._row_data(row)], 'fields': 'userEnteredValue'}}
+                                for row_number, row in rows)
+                self.google_sheet.custom_request(requests, fields='spreadsheetId')
+                # лист запоминается, как и при дописывании строк, и не создается и не скачивается повторно
+                self._sheets_shops[name_shop] = [sheet_shop, max(lastrow, max(number for number, _ in rows))]
+            METRICS.inc('sheets_rows_total', len(rows), shop=name_shop, op='update')
+            logger.success(f'На листе магазина {name_shop} обновлено строк {len(rows)}')
+            return True
+        except Exception as ex:
+            logger.error(f'Возникла ошибка при обновлении строк в Google-таблице {ex}')
+            return False
+
+
+class SheetUploader(threading.Thread):
+    """
+    Фоновая запись строк товаров в лист магазина во время парсинга.
+    Новые строки передаются методом put и дописываются в конец листа, изменившиеся строки режима delta
+    передаются методом update и обновляются на месте. Запись идет пачками по batch_size строк
+    или не реже одного раза в interval секунд. Очередь ограничена max_queue строками,
+    поэтому при медленной записи парсинг ждет, а память не растет
+    """
+
+    def __init__(self, gsheet, name_shop, batch_size=100, interval=30, max_queue=1000, title=True, on_saved=None,
+                 on_updated=None, profiler=None):
+        super().__init__(name=f'uploader-{name_shop}', daemon=True)
+        self.gsheet = gsheet
+        self.name_shop = name_shop
+        self.title = title  # записывать ли заголовок таблицы с первой пачкой
+        self.on_saved = on_saved  # функция (строки, номер первой строки на листе) после записи пачки
+        self.on_updated = on_updated  # функция (список (номер строки, строка)) после обновления пачки на листе
+        self.batch_size = batch_size
+        self.interval = interval
+        self.count = 0  # кол-во строк, записанных на лист
+        self.count_failed = 0  # кол-во строк, не записанных на лист (сохранены в csv или потеряны)
+        self.count_updated = 0  # кол-во строк, обновленных на листе
+        self.count_update_failed = 0  # кол-во строк, не обновленных на листе
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = object()  # признак завершения записи в очереди
+        if profiler is not None:
+            # в режиме профилирования время записи пачек накапливается в профиле этапа sheets магазина
+            self._flush = profiler.wrap(self._flush, name_shop, 'sheets')
+            self._flush_changed = profiler.wrap(self._flush_changed, name_shop, 'sheets')
+        self.start()
+
+    def put(self, row):
+        self._queue.put((None, row))
+
+    def update(self, row_number, row):
+        # изменившаяся строка товара, записанная на лист в строку row_number
+        self._queue.put((row_number, row))
+
+    def close(self):
+        # записываем оставшиеся строки и дожидаемся завершения потока
+        self._queue.put(self._closed)
+        self.join()
+        logger.info(f'В лист магазина {self.name_shop} записано строк {self.count}, '
+                    f'обновлено строк {self.count_updated}')
+        if self.count_failed or self.count_update_failed:
+            logger.warning(f'В лист магазина {self.name_shop} не записано строк {self.count_failed}, '
+                           f'не обновлено строк {self.count_update_failed}')
+
+    def run(self):
+        batch, changed = [], []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is self._closed:
+                self._flush(batch)
+                self._flush_changed(changed)
+                return
+            if item is not None:
+                row_number, row = item
+                if row_number is None:
+                    batch.append(row)
+                else:
+                    changed.append((row_number, row))
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+            if len(changed) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush_changed(changed)
+                changed = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.interval
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        rows = list(batch)
+        first_row = None
+        try:
+            # заголовок таблицы записывается с первой пачкой, записанной на лист
+            first_row = self.gsheet.save_result_parsing(self.name_shop, batch, title=self.title and self.count == 0)
+            if first_row is not None and self.on_saved is not None:
+                self.on_saved(rows, first_row)
+        except Exception as ex:
+            logger.error(f'Ошибка фоновой записи в Google-таблицу {ex}')
+        if first_row is None:
+            self.count_failed += len(rows)
+            logger.warning(f'Пачка из {len(rows)} строк не записана в лист магазина {self.name_shop}')
+            return
+        self.count += len(rows)
+        logger.debug(f'Записана пачка из {len(rows)} строк в лист магазина {self.name_shop}')
+
+    def _flush_changed(self, changed):
+        # снимки строк сохраняются только после обновления на листе, иначе строки обновятся при следующем запуске
+        if not changed:
+            return
+        updated = False
+        try:
+            updated = self.gsheet.update_rows(self.name_shop, changed)
+            if updated and self.on_updated is not None:
+                self.on_updated(changed)
+        except Exception as ex:
+            logger.error(f'Ошибка фонового обновления строк в Google-таблице {ex}')
+        if updated:
+            self.count_updated += len(changed)
+        else:
+            self.count_update_failed += len(changed)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+"""
+Локальный дисковый HTTP-кэш страниц листинга и товаров с условной перепроверкой.
+Для каждой ссылки хранятся заголовки ETag/Last-Modified, хэш содержимого, html-код страницы
+и результат ее парсинга. При повторном запросе отправляются If-None-Match/If-Modified-Since:
+ответ 304 или ответ 200 с тем же хэшем считаются попаданием в кэш, и страница не парсится повторно.
+Размер кэша ограничен, при превышении удаляются давно не использованные страницы.
+Страница, загрузка которой остановлена после получения нужных полей (streaming.PartialResponse
+с complete=False), хранится только хэшем прочитанной части и результатом парсинга: без html-кода
+и без ETag/Last-Modified, поэтому ответ 304 никогда не отдает из кэша обрезанную страницу
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class HttpCache:
+    """Дисковый кэш страниц сайта с индексом в SQLite"""
+
+    def __init__(self, directory, max_size=500 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size  # максимальный размер html-кода страниц в кэше, байт
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS page (
+                url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, hash TEXT NOT NULL,
+                size INTEGER NOT NULL, used REAL NOT NULL, meta TEXT)''')
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self.hits = 0  # ответ 304 или неизмененное содержимое
+        self.misses = 0  # новая или измененная страница
+        self.not_modified = 0  # из них ответов 304
+
+    def _file(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+
+    def headers(self, url):
+        """Заголовки условного запроса для ссылки, если она уже есть в кэше"""
+        with self._lock:
+            row = self._connection.execute('SELECT etag, last_modified FROM page WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def load(self, url):
+        """html-код страницы из кэша после ответа 304 или None, если его нет"""
+        try:
+            with open(self._file(url), 'r', encoding='utf-8') as file:
+                text = file.read()
+        except OSError:
+            # без html-кода запись бесполезна, следующий запрос будет без условных заголовков
+            with self._lock, self._connection:
+                self._connection.execute('DELETE FROM page WHERE url = ?', (url,))
+            return None
+        with self._lock:
+            self.hits += 1
+            self.not_modified += 1
+            with self._connection:
+                self._connection.execute('UPDATE page SET used = ? WHERE url = ?', (time.time(), url))
+        return text
+
+    def store(self, url, response):
+        """
+        Сохраняет страницу с ответом 200, у прочитанной не до конца страницы сохраняется только хэш
+        :return: True, если содержимое изменилось с прошлого раза или страницы не было в кэше
+        """
+        content_hash = hashlib.sha1(response.content).hexdigest()
+        partial = not getattr(response, 'complete', True)
+        etag = None if partial else response.headers.get('ETag')
+        last_modified = None if partial else response.headers.get('Last-Modified')
+        with self._lock:
+            row = self._connection.execute('SELECT hash FROM page WHERE url = ?', (url,)).fetchone()
+            changed = row is None or row[0] != content_hash
+            if changed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if changed and partial:
+            try:  # html-код прежней полной версии страницы больше не действителен
+                os.remove(self._file(url))
+            except OSError:
+                pass
+        elif changed:
+            with open(self._file(url), 'w', encoding='utf-8') as file:
+                file.write(response.text)
+        with self._lock, self._connection:
+            if changed:  # результат парсинга прежней версии страницы больше не действителен
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                    (url, etag, last_modified, content_hash, 0 if partial else len(response.content), time.time()))
+            else:
+                self._connection.execute('UPDATE page SET etag = ?, last_modified = ?, used = ? WHERE url = ?',
+                                         (etag, last_modified, time.time(), url))
+        if changed:
+            self._evict()
+        return changed
+
+    def get_meta(self, url):
+        """Сохраненный результат парсинга страницы или None"""
+        with self._lock:
+            row = self._connection.execute('SELECT meta FROM page WHERE url = ?', (url,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def set_meta(self, url, meta):
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE page SET meta = ? WHERE url = ?',
+                                     (json.dumps(meta, ensure_ascii=False), url))
+
+    def _evict(self):
+        # удаляем давно не использованные страницы, пока размер кэша больше max_size
+        with self._lock:
+            total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM page').fetchone()[0]
+            if total <= self.max_size:
+                return
+            removed = []
+            for url, size in self._connection.execute('SELECT url, size FROM page ORDER BY used'):
+                if total <= self.max_size * 0.9:
+                    break
+                removed.append(url)
+                total -= size
+            with self._connection:
+                self._connection.executemany('DELETE FROM page WHERE url = ?', [(url,) for url in removed])
+        for url in removed:
+            try:
+                os.remove(self._file(url))
+            except OSError:
+                pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'not_modified': self.not_modified,
+                'hit_rate': round(self.hits / total, 3) if total else 0}
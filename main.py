@@ -1,94 +1,263 @@
 import os
 import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from loguru import logger
 
 import authorization
-from googlesheetbot import GSheetsBot
+from frontier import Frontier
+from googlesheetbot import GSheetsBot, SheetUploader
+from httpcache import HttpCache
+from metrics import METRICS, MetricsServer
 from settings.settings import FILE_FOR_PARSING
+from parsepool import ParserPool
+from profiling import Profiler, profile_memory, profile_stage
+from ratelimit import HostRateLimiter
+from retry import CircuitBreaker
+from rowcache import RowCache
+from sessionpool import SessionPool
+from sessionstore import SessionStore
+from snapshot import SnapshotIndex
 from trademebot import TrademeParserBot
+from transport import Transport
 
-if __name__ == '__main__':
-    path_log = os.getcwd() + f'\\logs\\debug.log'
-    logger.add(path_log, level='DEBUG', compression="zip", rotation="9:00", retention="3 days", encoding='utf-8')
+WORKERS = 4  # количество одновременных запросов к страницам одного магазина
+SHOP_WORKERS = 3  # количество одновременно парсящихся магазинов
+PARSER_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # процессы разбора страниц товаров, 0 - разбор в потоках загрузки
+BROWSERS = 2  # размер пула браузеров для страниц без авторизации, 0 - без браузеров
+BROWSER_MAX_PAGES = 100  # браузер перезапускается после этого кол-ва страниц
+COOKIES_FILE = '\\pickles\\cookies.json'  # Cookies последней успешной сессии для запуска без браузера
+ACCOUNTS_DIR = '\\pickles\\accounts'  # сохраненные Cookies дополнительных аккаунтов, по файлу на аккаунт
+MAX_SESSION_FAILURES = 20  # сессия аккаунта выводится из пула после стольких страниц без авторизации подряд
+RATE = 0.25  # общий бюджет запросов к сайту, запросов в секунду
+BATCH_SIZE = 100  # размер пачки строк для записи в Google-таблицу во время парсинга
+BATCH_INTERVAL = 30  # максимальный интервал между записями пачек, секунд
+FRONTIER_FILE = '\\shops\\frontier.db'  # хранилище состояния очереди парсинга для допарсинга
+HTTP_CACHE_DIR = '\\cache'  # папка HTTP-кэша страниц листинга и товаров
+HTTP_CACHE_SIZE = 500 * 1024 * 1024  # максимальный размер HTTP-кэша, байт
+POOL_SIZE = WORKERS * SHOP_WORKERS  # соединений с сайтом в пуле сессии, по одному на одновременный запрос
+DNS_TTL = 300  # время хранения адреса сайта в кэше DNS, секунд, 0 - без кэша
+HTTP2 = False  # сессии на httpx с HTTP/2 вместо requests, требуется pip install httpx[http2]
+STREAM_PRODUCTS = True  # страницы товаров загружаются до получения всех полей, без скриптов и подвала
+# при потоковой загрузке разбирается только начало страницы до полей товара, и разбор идет в потоке запроса:
+# передача в процесс пула означала бы второй разбор, поэтому пул PARSER_WORKERS запускается,
+# только если страницы загружаются целиком (STREAM_PRODUCTS = False или сессии HTTP/2)
+ROW_CACHE_SIZE = 20000  # строк товаров в памяти, повторные листинги в магазинах запуска не запрашиваются
+ROW_CACHE_FILE = '\\shops\\rows.db'  # вытесненные из памяти строки товаров запуска, None - только память
+DELTA = True  # повторный парсинг только новых и изменившихся товаров, False - полный парсинг магазинов
+SNAPSHOT_FILE = '\\shops\\snapshot.db'  # снимки строк товаров, уже записанных в Google-таблицу
+REVALIDATE_AFTER = 7 * 24 * 3600  # через сколько секунд в режиме delta товар проверяется повторно
+RETRY_ATTEMPTS = 3  # повторы неудачной страницы в том же запуске, пауза растет 5, 10, 20... секунд
+BREAKER_THRESHOLD = 0.5  # доля ошибок среди последних ответов, при которой запросы к сайту приостанавливаются
+BREAKER_COOLDOWN = 120  # пауза запросов к сайту при всплеске ошибок, секунд
+METRICS_ADDRESS = ('127.0.0.1', 9108)  # адрес страницы метрик Prometheus /metrics, None - без страницы
+METRICS_REPORT = '\\logs\\metrics.json'  # JSON-отчет с метриками запуска
+METRICS_FILE = '\\logs\\metrics.prom'  # метрики в формате Prometheus для textfile collector
+PROFILE = False  # режим профилирования: cProfile и tracemalloc по магазинам и этапам, магазины парсятся по одному
+PROFILE_DIR = '\\profile'  # папка профилей режима профилирования
 
-    logger.info(f'Запуск скрипта')
-    cookies_selenium = authorization.get_cookies()  # в ручном режиме получаем Cookies
 
-    if not cookies_selenium:
-        logger.error(f'Cookies для дальнейшей работы не получены, завершаем программу')
-        sys.exit(1)
+def uploader_snapshot(snapshot, name_shop):
+    """
+    параметры SheetUploader для режима delta: заголовок пишется только на пустой лист, снимки строк
+    с номерами на листе сохраняются только после записи или обновления строк на листе
+    """
+    if snapshot is None:
+        return {}
+    return {'title': not snapshot.has_rows(name_shop),
+            'on_saved': lambda rows, first_row: snapshot.set_row_numbers(name_shop, rows, first_row),
+            'on_updated': lambda rows: snapshot.mark_updated(name_shop, rows)}
+
 
-    if not FILE_FOR_PARSING:  # обычный режим работы скрипта
-        parser = TrademeParserBot(cookies=cookies_selenium)  # file_for_parsing='data_for_parsing.json')
-        logger.info(f'Создана сессия для парсинга и добавлены Cookies для авторизации')
-    else:
-        parser = TrademeParserBot(cookies=cookies_selenium, file_for_parsing=FILE_FOR_PARSING)
-        name_shop = list(parser.data_for_parsing.keys())[0]
-        logger.warning(f'Запущен режим допарсинга из файла по магазину {name_shop}')
-        logger.info(f'Создана сессия для парсинга и добавлены Cookies для авторизации')
+def authorized_parser(session_store, **options):
+    """
+    бот с авторизованной сессией: сначала одним запросом проверяются Cookies прошлого запуска,
+    браузер для ручной авторизации открывается, только если они больше не действуют
+    :param options: параметры TrademeParserBot
+    :return: TrademeParserBot или None, если авторизоваться не удалось
+    """
+    transport = options.setdefault('transport', Transport(pool_size=POOL_SIZE, dns_ttl=DNS_TTL, http2=HTTP2))
+    cookies = session_store.load()
+    if cookies:
+        logger.info(f'Проверяем Cookies прошлого запуска из файла {os.path.basename(session_store.path)}')
+        parser = TrademeParserBot(session=TrademeParserBot._create_session_cookies(cookies, transport),
+                                  session_store=session_store, **options)
+        if parser.check_auth():
+            logger.info(f'Сохраненные Cookies действуют, авторизация в браузере не нужна')
+            return parser
+        logger.warning(f'Сохраненные Cookies не действуют, переходим к авторизации в браузере')
 
+    cookies_selenium = authorization.get_cookies()  # в ручном режиме получаем Cookies
+    if not cookies_selenium:
+        logger.error(f'Cookies для дальнейшей работы не получены')
+        return None
+    parser = TrademeParserBot(cookies=cookies_selenium, session_store=session_store, **options)
+    logger.info(f'Создана сессия для парсинга и добавлены Cookies для авторизации')
     logger.info(f'Проверяем авторизацию в текущей сессии после добавления Cookies')
     if not parser.check_auth():
-        logger.error(f'Работа скрипта завершена из-за ошибки авторизации')
-        logger.error(f'Попробуйте позже или обратитесь к разработчику')
         logger.debug(f'Счетчик запросов к сайту {parser.count_requests}')
-        sys.exit(1)
+        return None
+    return parser
 
-    if not FILE_FOR_PARSING:
-        shops = []  # список названий магазинов и ссылок на их листинг из Google-таблицы
+
+def parse_shop(parser, gsheet, shop, snapshot, profiler=None):
+    """
+    парсинг одного магазина в потоке пула магазинов: страницы листинга, товары и запись в Google-таблицу
+    :param parser: отдельный TrademeParserBot магазина с общими сессией и бюджетом запросов
+    :param shop: список из наименования магазина и ссылки на листинг или наименование магазина при допарсинге
+    :param profiler: profiling.Profiler в режиме профилирования
+    """
+    name_shop = shop[0].strip('\r') if isinstance(shop, list) else shop
+    with profile_stage(profiler, name_shop, 'listing'):
+        parser.parsing_shop(shop)  # получение ссылок на товары магазина
+    # запись в таблицу идет в потоке SheetUploader, время записи профилируется в нем, а память этапа sheets
+    # снимается один раз за магазин и пересекается с памятью этапа products
+    with profile_memory(profiler, name_shop, 'sheets'):
+        logger.info(f'Начинаем запись товаров в Google таблицу по магазину {name_shop} во время парсинга')
+        uploader = SheetUploader(gsheet, name_shop, batch_size=BATCH_SIZE, interval=BATCH_INTERVAL,
+                                 profiler=profiler, **uploader_snapshot(snapshot, name_shop))
         try:
-            logger.info(f'Открываем Google-таблицу и получаем список магазинов')
-            gsheet = GSheetsBot()
-            shops = gsheet.shops  # получаем список магазинов
-            logger.info(f'Выбрано для парсинга {len(shops)} магазин(a/ов)')
+            with profile_stage(profiler, name_shop, 'products'):
+                # парсинг данных страниц товаров, изменившиеся товары режима delta обновляются на листе пачками
+                for row in parser.iter_products(name_shop, on_changed=uploader.update):
+                    uploader.put(row)
+            logger.success(f'В Google-таблицу или csv-файл успешно записаны все товары магазина {name_shop}')
         except Exception as ex:
-            logger.error(f'Работа скрипта завершена из-за ошибки {ex}')
-            logger.error(f'Попробуйте позже или обратитесь к разработчику')
-            sys.exit(1)
+            if parser.count_no_auth <= 0:
+                raise  # авторизация потеряна, ошибка обрабатывается в пуле магазинов
+            logger.error(f'Ошибка {ex}. Обратитесь к разработчику')
+            # из-за ошибки в Google-таблицу записана только часть данных парсинга товаров
+            logger.warning(f'В Google-таблицу или csv-файл по магазину {name_shop} записаны НЕ все товары')
+        finally:
+            uploader.close()  # записываем последнюю пачку строк
 
-    logger.info(f'НАЧИНАЕМ ПАРСИНГ!')
 
-    parser.count_requests = 0  # для тестирования
+if __name__ == '__main__':
+    path_log = os.getcwd() + f'\\logs\\debug.log'
+    logger.add(path_log, level='DEBUG', compression="zip", rotation="9:00", retention="3 days", encoding='utf-8')
+
+    logger.info(f'Запуск скрипта')
+    if METRICS_ADDRESS:
+        try:
+            MetricsServer(METRICS_ADDRESS).start()
+        except OSError as ex:  # порт занят: парсинг продолжается, метрики сохраняются только в файлы
+            logger.warning(f'Не удалось запустить сервер метрик на {METRICS_ADDRESS}: {ex}')
+            logger.warning(f'Метрики будут сохранены только в файлы {METRICS_FILE} и {METRICS_REPORT}')
+
+    frontier = Frontier(os.getcwd() + FRONTIER_FILE)
+    if FILE_FOR_PARSING and not frontier.load_all():
+        logger.info(f'В хранилище {FRONTIER_FILE} нет незавершенного парсинга магазинов')
+        sys.exit(0)
+    http_cache = HttpCache(os.getcwd() + HTTP_CACHE_DIR, max_size=HTTP_CACHE_SIZE)
+    snapshot = SnapshotIndex(os.getcwd() + SNAPSHOT_FILE, revalidate_after=REVALIDATE_AFTER) if DELTA else None
+    rate_limiter = HostRateLimiter(rate=RATE)  # общий бюджет запросов к сайту для всех магазинов
+    # при допарсинге незавершенные ссылки читаются из хранилища очереди парсинга
+    parser = authorized_parser(SessionStore(os.getcwd() + COOKIES_FILE), file_for_parsing=FILE_FOR_PARSING or None,
+                               workers=WORKERS, frontier=frontier, http_cache=http_cache, snapshot=snapshot,
+                               rate_limiter=rate_limiter)
+    if parser is None:
+        logger.error(f'Работа скрипта завершена из-за ошибки авторизации')
+        logger.error(f'Попробуйте позже или обратитесь к разработчику')
+        sys.exit(1)
+    if FILE_FOR_PARSING:
+        logger.warning(f'Запущен режим допарсинга из файла по магазинам {", ".join(parser.data_for_parsing)}')
+
+    session_pool = None  # запросы через сессии нескольких аккаунтов, если сохранены Cookies других аккаунтов
+    accounts = SessionPool.load_vault(os.getcwd() + ACCOUNTS_DIR)
+    if accounts:
+        session_pool = SessionPool(max_failures=MAX_SESSION_FAILURES)
+        session_pool.add(parser.session, 'main', parser.session_store)
+        for name_account, store, cookies in accounts:
+            logger.info(f'Проверяем авторизацию сессии аккаунта {name_account}')
+            session = TrademeParserBot._create_session_cookies(cookies, parser.transport)
+            if parser.check_auth(session, store):
+                session_pool.add(session, name_account, store)
+            else:
+                logger.warning(f'Сессия аккаунта {name_account} не авторизована и не добавлена в пул')
+        logger.info(f'В пуле сессий аккаунтов {len(session_pool)}')
+        # бюджет запросов растет с количеством аккаунтов
+        rate_limiter = HostRateLimiter(rate=RATE * len(session_pool))
 
+    shops = []  # список названий магазинов и ссылок на их листинг из Google-таблицы
     try:
+        logger.info(f'Открываем Google-таблицу и получаем список магазинов')
+        gsheet = GSheetsBot()
         if not FILE_FOR_PARSING:
-            for shop in shops:
-                parser.parsing_shop(shop)  # получение ссылок на товары магазина
-                name_shop = shop[0].strip('\r')
-                try:
-                    parser.parsing_products(name_shop)  # парсинг данных страниц товаров
-                    result_parsing = parser.result_parsing_products
-                    logger.info(f'Начинаем запись товаров в Google таблицу по магазину {name_shop}')
-                    gsheet.save_result_parsing(name_shop, result_parsing)
-                    logger.success(f'В Google-таблицу или csv-файл успешно записаны все товары')
-                except Exception as ex:
-                    logger.error(f'Ошибка {ex}. Обратитесь к разработчику')
-                    # из-за ошибки сохраняем в Google-таблицу только часть данных парсинга товаров
-                    result_parsing = parser.result_parsing_products
-                    gsheet.save_result_parsing(name_shop, result_parsing)
-                    logger.warning(f'В Google-таблицу или csv-файл по магазину {name_shop} записаны НЕ все товары')
-
+            shops = gsheet.shops  # получаем список магазинов
         else:
-            try:
-                # допарсинг товаров из файла
-                parser.parsing_shop(name_shop)  # допарсинг страниц листинга и получение ссылок на товары
-                parser.parsing_products(name_shop)  # допарсинг данных страниц товаров
-                result_parsing = parser.result_parsing_products
-                gsheet = GSheetsBot()
-                logger.info(f'Начинаем запись товаров в Google таблицу по магазину {name_shop}')
-                gsheet.save_result_parsing(name_shop, result_parsing)
-                logger.success(f'В Google-таблицу или csv-файл успешно записаны все товары')
-            except Exception as ex:
-                logger.error(f'Ошибка {ex}. Обратитесь к разработчику')
-                # из-за ошибки сохраняем в Google-таблицу только часть данных парсинга товаров
-                result_parsing = parser.result_parsing_products
-                gsheet = GSheetsBot()
-                gsheet.save_result_parsing(name_shop, result_parsing)
-                logger.warning(f'В Google-таблицу или csv-файл по магазину {name_shop} записаны НЕ все товары')
-
+            shops = list(parser.data_for_parsing)  # магазины с незавершенным парсингом
+        logger.info(f'Выбрано для парсинга {len(shops)} магазин(a/ов)')
     except Exception as ex:
         logger.error(f'Работа скрипта завершена из-за ошибки {ex}')
-        logger.error(f'Необходимо заново запустить скрипт и пройти процедуру авторизации')
-        logger.debug(f'Счетчик запросов к сайту {parser.count_requests}')
+        logger.error(f'Попробуйте позже или обратитесь к разработчику')
+        sys.exit(1)
+
+    profiler = None
+    shop_workers = SHOP_WORKERS
+    if PROFILE:
+        profiler = Profiler(os.getcwd() + PROFILE_DIR)
+        shop_workers = 1  # память процесса относится к одному магазину
+        logger.warning(f'Включен режим профилирования, профили сохраняются в папку {PROFILE_DIR}')
+
+    logger.info(f'НАЧИНАЕМ ПАРСИНГ!')
+    logger.info(f'Одновременно парсится магазинов {shop_workers}')
+
+    def run_shop(shop):
+        # у каждого магазина свой бот, сессия с Cookies, бюджет запросов и хранилища общие
+        if stop.is_set():
+            return
+        shop_parser = TrademeParserBot(session=parser.session, workers=WORKERS, frontier=frontier,
+                                       http_cache=http_cache, snapshot=snapshot, rate_limiter=rate_limiter,
+                                       session_store=parser.session_store, browser_pool=browser_pool,
+                                       session_pool=session_pool, parser_pool=parser_pool,
+                                       retry_attempts=RETRY_ATTEMPTS, breaker=breaker, row_cache=row_cache,
+                                       profiler=profiler, transport=parser.transport,
+                                       stream_products=STREAM_PRODUCTS)
+        if FILE_FOR_PARSING:
+            shop_parser.data_for_parsing = {shop: parser.data_for_parsing[shop]}
+        try:
+            parse_shop(shop_parser, gsheet, shop, snapshot, profiler)
+        except Exception as ex:
+            # ошибка одного магазина не останавливает парсинг остальных
+            logger.error(f'Парсинг магазина {shop[0] if isinstance(shop, list) else shop} завершен из-за ошибки {ex}')
+            if not shop_parser.check_auth():  # при потере авторизации новые магазины не запускаются
+                stop.set()
+                logger.error(f'Необходимо заново запустить скрипт и пройти процедуру авторизации')
+        finally:
+            with counter_lock:
+                parser.count_requests += shop_parser.count_requests
+                METRICS.save_prometheus(os.getcwd() + METRICS_FILE)  # метрики обновляются после каждого магазина
+
+    browser_pool = None
+    if BROWSERS:
+        browser_pool = authorization.BrowserPool(parser.session, size=BROWSERS, max_pages=BROWSER_MAX_PAGES)
+
+    # общий для всех магазинов, при потоковой загрузке страницы разбираются в потоках запросов
+    parser_pool = ParserPool(0 if STREAM_PRODUCTS and not HTTP2 else PARSER_WORKERS)
+    breaker = CircuitBreaker(threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN)  # общий для всех магазинов
+    row_cache = RowCache(size=ROW_CACHE_SIZE, path=os.getcwd() + ROW_CACHE_FILE if ROW_CACHE_FILE else None)
+
+    stop = threading.Event()  # авторизация потеряна, новые магазины не запускаются
+    counter_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=shop_workers) as executor:
+        futures = [executor.submit(run_shop, shop) for shop in shops]
+        for future in as_completed(futures):
+            future.result()
+    if browser_pool is not None:
+        browser_pool.close()
+    parser_pool.close()
+    logger.info(f'Статистика кэша строк товаров {row_cache.stats()}')
+    row_cache.close()
+    logger.info(f'Статистика соединений и сжатия {parser.transport.stats()}')
+    parser.transport.close()
+
+    logger.debug(f'Счетчик запросов к сайту {parser.count_requests}')
+    METRICS.save_report(os.getcwd() + METRICS_REPORT)
+    if breaker.trips:
+        logger.warning(f'Запросы к сайту приостанавливались из-за ошибок {breaker.trips} раз(а)')
+    if session_pool is not None:
+        logger.info(f'Статистика сессий аккаунтов {session_pool.stats()}')
+    if stop.is_set():
         sys.exit(1)
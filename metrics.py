@@ -0,0 +1,184 @@
+"""
+Метрики работы парсера по магазинам и этапам (listing - страницы листинга, product - страницы товаров).
+Гистограммы: время ответа сайта, размер ответа, время разбора страницы и извлечения полей,
+время записи в Google-таблицу. Счетчики: запросы по коду ответа, время ожидания в бюджете запросов
+и паузах при всплеске ошибок, дополнительные запросы к страницам без признака авторизации.
+Метрики собираются в общем объекте METRICS и выгружаются в JSON-отчет запуска и в текстовый формат
+Prometheus: в файл или по адресу http://host:port/metrics через MetricsServer
+"""
+import bisect
+import http.server
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from loguru import logger
+
+PREFIX = 'trademe_'  # префикс имен метрик в формате Prometheus
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class _Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - значения больше buckets[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # верхняя граница корзины, в которую попадает квантиль q
+        rank, total = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 3),
+                'mean': round(self.sum / self.count, 4) if self.count else 0,
+                'p50': round(self.quantile(0.5), 4), 'p95': round(self.quantile(0.95), 4), 'max': round(self.max, 4)}
+
+
+class Metrics:
+    """Гистограммы и счетчики с метками shop, stage и другими, потокобезопасно"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._histograms = {}  # (имя, метки) - _Histogram
+        self._counters = {}  # (имя, метки) - значение
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def observe(self, name, value, **labels):
+        """Значение в гистограмму name, границы корзин по окончанию имени _seconds или _bytes"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(
+                    BYTES_BUCKETS if name.endswith('_bytes') else SECONDS_BUCKETS)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """Увеличение счетчика name, имя счетчика оканчивается на _total"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # время выполнения блока в гистограмму name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def report(self):
+        """Отчет запуска: сводка гистограмм и значения счетчиков по меткам"""
+        with self._lock:
+            histograms, counters = {}, {}
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, []).append(dict(labels=dict(labels), **histogram.summary()))
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': round(value, 3)})
+        return {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'duration': round(time.time() - self.started, 1), 'histograms': histograms, 'counters': counters}
+
+    def save_report(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, ensure_ascii=False, indent=2)
+        logger.info(f'Отчет с метриками запуска сохранен в файл {path}')
+
+    def prometheus(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        with self._lock:
+            names = {}
+            for name, labels in sorted(self._histograms):
+                names.setdefault(name, []).append(labels)
+            for name, all_labels in names.items():
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for labels in all_labels:
+                    histogram = self._histograms[name, labels]
+                    total = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append(f'{PREFIX}{name}_bucket{_labels(labels + (("le", bound),))} {total}')
+                    lines.append(f'{PREFIX}{name}_sum{_labels(labels)} {histogram.sum}')
+                    lines.append(f'{PREFIX}{name}_count{_labels(labels)} {histogram.count}')
+            names = {}
+            for name, labels in sorted(self._counters):
+                names.setdefault(name, []).append(labels)
+            for name, all_labels in names.items():
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                for labels in all_labels:
+                    lines.append(f'{PREFIX}{name}{_labels(labels)} {self._counters[name, labels]}')
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, path):
+        # файл для textfile collector node_exporter
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus())
+
+
+def _labels(labels):
+    # метки в формате Prometheus {name="value",...}
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+METRICS = Metrics()  # общие метрики процесса
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Отдача метрик в формате Prometheus по адресу http://host:port/metrics"""
+    daemon_threads = True
+
+    def __init__(self, address, metrics=METRICS):
+        self.metrics = metrics
+        super().__init__(address, _MetricsHandler)
+
+    def start(self):
+        # обслуживание запросов в фоновом потоке, остановка методом shutdown()
+        thread = threading.Thread(target=self.serve_forever, name='metrics-server', daemon=True)
+        thread.start()
+        logger.info(f'Метрики доступны по адресу http://{self.server_address[0]}:{self.server_address[1]}/metrics')
+        return thread
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body, content_type = self.server.metrics.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] == '/report':
+            body, content_type = json.dumps(self.server.metrics.report(), ensure_ascii=False).encode('utf-8'), \
+                'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы к метрикам не пишутся в лог
@@ -0,0 +1,56 @@
+"""
+Результат открытия страницы сайта.
+Страница разбирается lxml не более одного раза и только при первом обращении к дереву Page.tree,
+дальше разобранное дерево используют проверка авторизации и все правила извлечения из extractors.
+Встроенный JSON состояния страницы так же декодируется один раз при первом обращении к Page.state.
+Для страницы, загруженной потоково (streaming.read_until), используется дерево, построенное при чтении
+"""
+import lxml.html
+
+from lxml.etree import ParserError
+
+from extractors import decode_state
+
+
+class Page:
+    """
+    Открытая страница: ответ сервера, разобранное дерево и признак авторизации
+    auth: 'login' - найдено ключевое слово авторизации LOGIN_CHECK,
+          'logout' - найдена только ссылка Log out,
+          'cache' - сервер ответил 304, страница взята из HTTP-кэша,
+          'browser' - страница получена в браузере пула authorization.BrowserPool,
+          False - страница получена дополнительным запросом без подтверждения авторизации
+    """
+
+    def __init__(self, url, text, auth=False, response=None, tree=None):
+        self.url = url  # итоговый адрес страницы после редиректов
+        self.text = text  # html-код страницы
+        self.auth = auth
+        self.response = response  # объект response, если страница получена через requests
+        self.cached = False  # страница не изменилась с прошлого запроса и есть в HTTP-кэше
+        self._tree = tree  # дерево, уже построенное при потоковой загрузке, иначе строится при обращении
+        self.streamed = tree is not None  # страница разобрана при потоковой загрузке, повторно не разбирается
+        self._state = False  # False - встроенный JSON еще не искали, None - его нет на странице
+
+    @classmethod
+    def from_response(cls, response, auth=False, tree=None):
+        return cls(response.url, response.text, auth=auth, response=response, tree=tree)
+
+    @property
+    def tree(self):
+        """Дерево lxml страницы, строится при первом обращении"""
+        if self._tree is None:
+            try:
+                self._tree = lxml.html.fromstring(self.text)
+            except ValueError:  # строка с объявлением кодировки внутри xml-заголовка
+                self._tree = lxml.html.fromstring(self.text.encode('utf-8'))
+            except ParserError:  # пустая страница
+                self._tree = lxml.html.fromstring('<html></html>')
+        return self._tree
+
+    @property
+    def state(self):
+        """Встроенный JSON состояния страницы или None, декодируется при первом обращении"""
+        if self._state is False:
+            self._state = decode_state(self.text)
+        return self._state
@@ -0,0 +1,53 @@
+"""
+Пул процессов разбора страниц товаров.
+Разбор html lxml и извлечение полей занимают процессор и держат GIL, поэтому при разборе в потоках
+загрузки страниц используется одно ядро. Потоки загрузки передают тело ответа (байты, кодировка и ссылка)
+в пул из workers процессов и получают обратно поля товара. Очередь пула ограничена количеством потоков
+загрузки: каждый поток ждет результат разбора своей страницы, прежде чем открыть следующую.
+Срабатывания правил extractors.FIELDS возвращаются вместе с полями и учитываются в основном процессе,
+а процесс пула получает с каждой страницей текущий порядок правил основного процесса
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from extractors import count_path, extract_product, product_fields, rule_order, set_rule_order
+from page import Page
+
+
+def parse_product_page(url, body, encoding, listing_id, order):
+    """
+    Разбор страницы товара в процессе пула
+    :param order: порядок правил полей в основном процессе, extractors.rule_order()
+    :return: (dict полей товара, способ получения строки, dict поле - сработавшее правило)
+    """
+    set_rule_order(order)
+    page = Page(url, body.decode(encoding or 'utf-8', errors='replace'))
+    return product_fields(page, listing_id)  # статистика учитывается в основном процессе
+
+
+class ParserPool:
+    """Процессы разбора страниц товаров, при workers=0 страницы разбираются в потоке загрузки"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+
+    def parse_product(self, page, listing_id):
+        """
+        Поля товара со страницы page
+        :type page: object Page
+        """
+        if self._executor is None:
+            return extract_product(page, listing_id)
+        response = page.response
+        if response is not None and response.status_code == 200:
+            body, encoding = response.content, response.encoding
+        else:  # страница из HTTP-кэша
+            body, encoding = page.text.encode('utf-8'), 'utf-8'
+        fields, path, rules = self._executor.submit(parse_product_page, page.url, body, encoding, listing_id,
+                                                    rule_order()).result()
+        count_path(path, rules)
+        return fields
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
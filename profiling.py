@@ -0,0 +1,138 @@
+"""
+Режим профилирования запуска по магазинам и этапам: listing (parsing_shop), products (парсинг товаров),
+sheets (запись в Google-таблицу).
+Время процессора снимается cProfile в каждом потоке, выполняющем этап: в вызывающем потоке этапа, в потоках
+пулов запросов и в потоке SheetUploader через Profiler.wrap. Профили потоков одного магазина и этапа накапливаются
+и объединяются в файл <магазин>.<этап>.pstats (просмотр: python -m pstats или snakeviz) и текстовую сводку
+<магазин>.<этап>.txt. Выделения памяти за время этапа по строкам кода снимаются tracemalloc и записываются
+в <магазин>.<этап>.memory.txt, снимки памяти и файлы отчетов делаются один раз на этап магазина.
+tracemalloc считает память всего процесса, поэтому в режиме профилирования магазины парсятся по одному.
+Запись в таблицу идет в потоке SheetUploader одновременно с парсингом товаров, поэтому память этапов sheets
+и products пересекается: в каждый из них попадают выделения другого. Разбор страниц в процессах parsepool
+в профиль не попадает
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from loguru import logger
+
+FRAMES = 1  # глубина стека выделений памяти, достаточно строки кода
+TOP = 30  # кол-во функций и строк кода в текстовых сводках
+
+
+class Profiler:
+    """Профили cProfile и выделения памяти tracemalloc по парам (магазин, этап)"""
+
+    def __init__(self, directory, top=TOP):
+        self.directory = directory
+        self.top = top
+        os.makedirs(directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(FRAMES)
+        self._profiles = {}  # (магазин, этап) - профили cProfile всех потоков этапа
+        self._memory = {}  # (магазин, этап) - Counter прироста памяти по строкам кода, байт
+        self._local = threading.local()  # профиль, включенный в текущем потоке, и профили потока по этапам
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _profiling(self, shop, stage):
+        # включает в текущем потоке профиль этапа, вложенные этапы учитываются во внешнем
+        if getattr(self._local, 'active', None) is not None:
+            yield
+            return
+        key = (shop, stage)
+        profiles = self._local.__dict__.setdefault('profiles', {})
+        profile = profiles.get(key)
+        if profile is None:
+            profile = profiles[key] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(key, []).append(profile)
+        try:
+            profile.enable()
+        except ValueError:  # с Python 3.12 профиль может быть включен только в одном потоке одновременно
+            yield
+            return
+        self._local.active = profile
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = None
+
+    def wrap(self, func, shop, stage):
+        """func, профилируемая в потоке, где она выполняется, для задач пулов потоков этапа"""
+        def profiled(*args, **kwargs):
+            with self._profiling(shop, stage):
+                return func(*args, **kwargs)
+        return profiled
+
+    @contextmanager
+    def stage(self, shop, stage):
+        """Профилирование этапа магазина в вызывающем потоке, по окончании этапа отчеты записываются в файлы"""
+        with self.memory(shop, stage), self._profiling(shop, stage):
+            yield
+
+    @contextmanager
+    def memory(self, shop, stage):
+        """
+        Выделения памяти за время этапа, по окончании отчеты этапа записываются в файлы. Время процессора
+        этапа, выполняемого в других потоках, снимается функциями, обернутыми Profiler.wrap
+        """
+        start = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            self._count_memory(shop, stage, start)
+            self.dump(shop, stage)
+
+    def _count_memory(self, shop, stage, start):
+        # прирост памяти за время этапа по строкам кода, без выделений самого tracemalloc
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        end = tracemalloc.take_snapshot().filter_traces(ignore)
+        with self._lock:
+            memory = self._memory.setdefault((shop, stage), Counter())
+            for diff in end.compare_to(start.filter_traces(ignore), 'lineno'):
+                memory[str(diff.traceback[0])] += diff.size_diff
+
+    def dump(self, shop, stage):
+        """Запись накопленных профиля и выделений памяти этапа магазина, при повторах этапа - с накоплением"""
+        with self._lock:
+            profiles = list(self._profiles.get((shop, stage), []))
+            memory = Counter(self._memory.get((shop, stage), {}))
+        name = os.path.join(self.directory, f'{_file_name(shop)}.{stage}')
+        if profiles:
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(name + '.pstats')
+            text = io.StringIO()
+            pstats.Stats(name + '.pstats', stream=text).sort_stats('cumulative').print_stats(self.top)
+            with open(name + '.txt', 'w', encoding='utf-8') as file:
+                file.write(text.getvalue())
+        current, peak = tracemalloc.get_traced_memory()
+        with open(name + '.memory.txt', 'w', encoding='utf-8') as file:
+            file.write(f'Память процесса {current / 1024 / 1024:.1f} MB, пик {peak / 1024 / 1024:.1f} MB\n')
+            file.write(f'Прирост памяти за этап по строкам кода, KB\n')
+            for line, size in memory.most_common(self.top):
+                file.write(f'{size / 1024:12.1f}  {line}\n')
+        logger.info(f'Профиль этапа {stage} магазина {shop} сохранен в {name}.*')
+
+
+def profile_stage(profiler, shop, stage):
+    """Профилирование этапа, если задан profiler, иначе пустой контекст"""
+    return profiler.stage(shop, stage) if profiler is not None else nullcontext()
+
+
+def profile_memory(profiler, shop, stage):
+    """Память этапа, выполняемого в других потоках, если задан profiler, иначе пустой контекст"""
+    return profiler.memory(shop, stage) if profiler is not None else nullcontext()
+
+
+def _file_name(shop):
+    # наименование магазина без символов, недопустимых в имени файла
+    return re.sub(r'(?u)[^-\w.]', '', str(shop).strip().replace(' ', '_'))
@@ -0,0 +1,149 @@
+"""
+Ограничение частоты запросов к сайту по алгоритму token bucket.
+Один общий бюджет запросов на каждый хост, который разделяют все потоки парсера.
+Скорость пополнения бюджета подстраивается под ответы сервера по схеме AIMD:
+аддитивное увеличение при быстрых успешных ответах, мультипликативное снижение при ошибках
+не чаще одного раза за время ответа сервера: ошибки запросов, отправленных до снижения, его не повторяют
+"""
+import random
+import threading
+import time
+
+from loguru import logger
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется со скоростью rate токенов в секунду, вмещает не более capacity токенов.
+    Каждый запрос забирает один токен, при пустом ведре поток ждет пополнения.
+    Пауза ожидания случайно меняется на долю jitter, как прежняя пауза randrange(3, 6), поэтому запросы
+    не идут к сайту с постоянным интервалом. Проснувшийся раньше поток снова ждет токен, скорость не превышается
+    """
+
+    def __init__(self, rate, capacity=1, jitter=0.25):
+        self.rate = rate  # скорость пополнения, запросов в секунду
+        self.capacity = capacity  # максимальный размер "всплеска" запросов
+        self.jitter = jitter  # разброс паузы ожидания, доля
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()  # накопленные по старой скорости токены сохраняем
+            self.rate = rate
+
+    def acquire(self):
+        """
+        Забирает токен, при необходимости ожидая его появления
+        :return: время ожидания в секундах
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                pause = (1 - self._tokens) / self.rate * random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(pause)
+            waited += pause
+
+
+class AimdController:
+    """
+    Регулятор скорости ведра токенов по обратной связи от сервера.
+    Быстрый ответ 200 увеличивает скорость на increase запросов в секунду,
+    ошибка, таймаут, страница без авторизации или рост задержки уменьшают ее в decrease раз.
+    После снижения следующие ошибки в течение cooldown секунд или средней задержки ответа, если она больше,
+    скорость не снижают: это ответы на запросы, отправленные еще до снижения, иначе несколько потоков,
+    одновременно получивших ошибку, снизили бы скорость в decrease ** потоков раз
+    """
+
+    def __init__(self, bucket, min_rate=0.05, max_rate=2.0, increase=0.02, decrease=0.5,
+                 latency_factor=2.0, fast_latency=2.0, cooldown=10.0):
+        self.bucket = bucket
+        self.min_rate = min_rate  # нижняя граница скорости, запросов в секунду
+        self.max_rate = max_rate  # верхняя граница скорости, запросов в секунду
+        self.increase = increase  # шаг аддитивного увеличения скорости
+        self.decrease = decrease  # множитель снижения скорости
+        self.latency_factor = latency_factor  # во сколько раз задержка должна превысить среднюю для снижения
+        self.fast_latency = fast_latency  # ответ быстрее этого времени в секундах считается быстрым
+        self.cooldown = cooldown  # минимальный интервал между снижениями скорости, секунд
+        self.latency = None  # скользящее среднее задержки ответа
+        self._decreased = None  # время последнего снижения скорости
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def success(self, latency):
+        with self._lock:
+            average = self.latency
+            self.latency = latency if average is None else average * 0.8 + latency * 0.2
+            if average is not None and latency > max(average * self.latency_factor, self.fast_latency):
+                self._back_off(f'задержка ответа выросла до {latency:.1f} c')
+            elif latency <= self.fast_latency:
+                self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+    def failure(self, reason):
+        with self._lock:
+            self._back_off(reason)
+
+    def _back_off(self, reason):
+        now = time.monotonic()
+        if self._decreased is not None and now - self._decreased < max(self.cooldown, self.latency or 0):
+            logger.debug(f'Темп запросов уже снижен до {self.bucket.rate:.3f} в секунду: {reason}')
+            return
+        self._decreased = now
+        self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease))
+        logger.warning(f'Снижаем темп запросов до {self.bucket.rate:.3f} в секунду: {reason}')
+
+
+class HostRateLimiter:
+    """
+    Набор ведер токенов по хостам. Все запросы к одному хосту расходуют общий бюджет,
+    независимо от количества потоков, которые их отправляют.
+    Скорость каждого ведра регулируется своим AimdController
+    """
+
+    def __init__(self, rate, capacity=1, jitter=0.25, **aimd):
+        self.rate = rate  # начальная скорость для нового хоста
+        self.capacity = capacity
+        self.jitter = jitter  # разброс паузы ожидания токена, доля
+        self.aimd = aimd  # параметры AimdController
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def controller(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = AimdController(TokenBucket(self.rate, self.capacity, self.jitter),
+                                                             **self.aimd)
+            return self._controllers[host]
+
+    def acquire(self, url):
+        return self.controller(url).bucket.acquire()
+
+    def success(self, url, latency):
+        self.controller(url).success(latency)
+
+    def failure(self, url, reason):
+        self.controller(url).failure(reason)
+
+    def current_rate(self, url):
+        """Текущая скорость запросов к хосту ссылки, запросов в секунду"""
+        return self.controller(url).rate
+
+    def rates(self):
+        """Текущие скорости по всем хостам"""
+        with self._lock:
+            return {host: controller.rate for host, controller in self._controllers.items()}
@@ -0,0 +1,22 @@
+"""
+Компактное хранение строк товаров.
+ProductRow - строка товара в виде кортежа с именованными полями без словаря атрибутов, кол-во упоминаний
+хранится как int, цена как float. Поддерживает индексацию и перебор, как прежние списки из 7 значений.
+Строки магазина в памяти не накапливаются: iter_products отдает их по одной, а SheetUploader
+записывает в таблицу или csv-файл пачками из ограниченной очереди
+"""
+from collections import namedtuple
+
+TITLE = ('№ Листинга', 'Кол-во', 'Ссылка на листинг', 'Товар', 'Описание', 'Цена', 'Признак цены')
+
+
+class ProductRow(namedtuple('ProductRow', ['listing_id', 'count', 'url', 'title', 'description', 'price',
+                                           'price_tag'])):
+    """Строка товара [id, count, url, title, description, price, price_tag]"""
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, values):
+        """ProductRow из списка или кортежа значений с приведением типов числовых полей"""
+        listing_id, count, url, title, description, price, price_tag = values
+        return cls(str(listing_id), int(count), url, title, description, float(price), price_tag)
@@ -0,0 +1,144 @@
+"""
+Повторные попытки открытия страниц в том же запуске.
+RetryQueue откладывает неудачную ссылку на время, растущее экспоненциально с номером попытки,
+со случайным разбросом, чтобы повторы разных ссылок не приходили на сайт одновременно.
+CircuitBreaker приостанавливает все запросы к сайту на cooldown секунд, если доля ошибок
+среди последних window ответов превысила threshold.
+RetryRunner выполняет задачи в пуле потоков и сам повторяет неудачные по RetryQueue
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from loguru import logger
+
+
+class RetryQueue:
+    """Отложенные повторы ссылок с экспоненциальной паузой и разбросом"""
+
+    def __init__(self, max_attempts=3, base=5, cap=300, jitter=0.5):
+        self.max_attempts = max_attempts  # сколько раз ссылка открывается повторно
+        self.base = base  # пауза перед первым повтором, секунд
+        self.cap = cap  # максимальная пауза, секунд
+        self.jitter = jitter  # разброс паузы, доля
+        self.attempts = {}  # кол-во повторов по ссылкам
+        self._heap = []  # (время повтора, порядковый номер, ссылка, данные)
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def backoff(self, attempt):
+        delay = min(self.cap, self.base * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add(self, key, payload=None):
+        """
+        Откладывает повтор ссылки key
+        :return: пауза до повтора, секунд, или None, если попытки исчерпаны
+        """
+        attempt = self.attempts.get(key, 0) + 1
+        if attempt > self.max_attempts:
+            return None
+        self.attempts[key] = attempt
+        delay = self.backoff(attempt)
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._order), key, payload))
+        return delay
+
+    def due(self):
+        """Ссылки, время повтора которых наступило: список (ссылка, данные)"""
+        now = time.monotonic()
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key, payload = heapq.heappop(self._heap)
+            ready.append((key, payload))
+        return ready
+
+    def wait_time(self):
+        """Секунд до ближайшего повтора или None, если повторов нет"""
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.monotonic())
+
+
+class CircuitBreaker:
+    """Пауза всех запросов к сайту при всплеске ошибок"""
+
+    def __init__(self, window=50, threshold=0.5, min_requests=20, cooldown=120):
+        self.threshold = threshold  # доля ошибок, при которой запросы приостанавливаются
+        self.min_requests = min_requests  # доля ошибок считается не меньше чем по стольким ответам
+        self.cooldown = cooldown  # пауза, секунд
+        self._results = deque(maxlen=window)  # True - успешный ответ, False - ошибка
+        self._open_until = 0
+        self.trips = 0  # сколько раз запросы приостанавливались
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        with self._lock:
+            self._results.append(ok)
+            if len(self._results) < self.min_requests:
+                return
+            errors = self._results.count(False) / len(self._results)
+            if errors >= self.threshold and time.monotonic() >= self._open_until:
+                self._open_until = time.monotonic() + self.cooldown
+                self._results.clear()
+                self.trips += 1
+                logger.warning(f'Доля ошибок {errors:.0%}, запросы к сайту приостановлены на {self.cooldown} с')
+
+    def wait(self):
+        """Ожидание окончания паузы перед запросом"""
+        with self._lock:
+            delay = self._open_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RetryRunner:
+    """
+    Выполнение func(key, payload) в пуле потоков с отложенными повторами неудачных задач.
+    Результаты отдаются по мере готовности, неудачный результат отдается, только когда попытки исчерпаны
+    """
+
+    def __init__(self, executor, func, retries, failed=lambda result: not result):
+        self.executor = executor
+        self.func = func
+        self.retries = retries
+        self.failed = failed  # признак неудачного результата, который нужно повторить
+        self._futures = {}
+
+    def submit(self, key, payload=None):
+        self._futures[self.executor.submit(self.func, key, payload)] = (key, payload)
+
+    def results(self):
+        """Генератор (key, payload, результат) до завершения всех задач и повторов"""
+        while self._futures or len(self.retries):
+            if self._futures:
+                done, _ = wait(self._futures, timeout=self.retries.wait_time(), return_when=FIRST_COMPLETED)
+            else:  # остались только отложенные повторы
+                time.sleep(self.retries.wait_time())
+                done = set()
+            for key, payload in self.retries.due():
+                logger.info(f'Повторная попытка {self.retries.attempts[key]} открыть {key}')
+                self.submit(key, payload)
+            for future in done:
+                key, payload = self._futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    logger.error(f'Ошибка выполнения задачи {key} {ex}')
+                    result = False
+                if self.failed(result):
+                    delay = self.retries.add(key, payload)
+                    if delay is not None:
+                        logger.warning(f'Не удалось открыть {key}, повтор через {delay:.0f} с')
+                        continue
+                yield key, payload, result
+
+    def cancel(self):
+        # при ошибке или досрочном закрытии генератора не ждем еще не начатые задачи
+        for future in self._futures:
+            future.cancel()
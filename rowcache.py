@@ -0,0 +1,105 @@
+"""
+Общий для всех магазинов кэш строк товаров в пределах одного запуска.
+Один и тот же листинг встречается на нескольких страницах листинга и в нескольких магазинах под ссылками
+разного вида, ключом кэша служит номер листинга (extractors.product_id). Строка товара без кол-ва упоминаний
+хранится в памяти до size листингов, давно не использованные вытесняются в SQLite-файл path, если он задан.
+Одновременные запросы одного листинга из разных потоков ждут результат первого, поэтому повторные
+ссылки на листинг не стоят ни одного запроса к сайту
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from records import ProductRow
+
+
+class RowCache:
+    """LRU строк товаров по номеру листинга с дисковым уровнем"""
+
+    def __init__(self, size=20000, path=None):
+        self.size = size  # кол-во строк в памяти
+        self._rows = OrderedDict()  # номер листинга - (url, title, description, price, price_tag)
+        self._loading = {}  # номер листинга - threading.Event запроса, который выполняется сейчас
+        self._lock = threading.Lock()
+        self._connection = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS row (listing_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            with self._connection:
+                self._connection.execute('DELETE FROM row')  # строки прошлого запуска могли устареть
+        self.hits = 0  # строка взята из памяти
+        self.disk_hits = 0  # строка взята из файла
+        self.misses = 0  # страница товара открыта
+
+    def _get(self, listing_id):
+        # строка из памяти или файла, вызывается под self._lock
+        data = self._rows.get(listing_id)
+        if data is not None:
+            self._rows.move_to_end(listing_id)
+            self.hits += 1
+            return data
+        if self._connection is None:
+            return None
+        row = self._connection.execute('SELECT data FROM row WHERE listing_id = ?', (listing_id,)).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        data = json.loads(row[0])
+        self._put(listing_id, data)
+        return data
+
+    def _put(self, listing_id, data):
+        # вызывается под self._lock
+        self._rows[listing_id] = data
+        self._rows.move_to_end(listing_id)
+        evicted = []
+        while len(self._rows) > self.size:
+            evicted.append(self._rows.popitem(last=False))
+        if evicted and self._connection is not None:
+            with self._connection:
+                self._connection.executemany('INSERT OR REPLACE INTO row VALUES (?, ?)',
+                                             [(key, json.dumps(value, ensure_ascii=False)) for key, value in evicted])
+
+    def fetch(self, listing_id, count, load):
+        """
+        Строка товара из кэша или результат load() при первом запросе листинга
+        :param count: кол-во упоминаний товара в текущем магазине
+        :param load: функция без параметров, возвращает ProductRow, False или 'STOP'
+        :return: ProductRow с кол-вом count, False или 'STOP'
+        """
+        while True:
+            with self._lock:
+                data = self._get(listing_id)
+                if data is not None:
+                    return ProductRow(listing_id, int(count), *data)
+                event = self._loading.get(listing_id)
+                if event is None:  # листинг еще никто не запрашивает
+                    event = self._loading[listing_id] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()  # после неудачного запроса другого потока листинг запрашивается снова
+
+        try:
+            result = load()
+            if isinstance(result, ProductRow):
+                with self._lock:
+                    self._put(listing_id, result[2:])
+            return result
+        finally:
+            with self._lock:
+                del self._loading[listing_id]
+            event.set()
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / total, 3) if total else 0}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
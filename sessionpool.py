@@ -0,0 +1,103 @@
+"""
+Пул авторизованных сессий нескольких аккаунтов сайта.
+Запросы распределяются на наименее загруженную сессию, при равной загрузке по кругу.
+Для каждой сессии считаются подряд идущие страницы без признака авторизации, сессия,
+не прошедшая проверку max_failures раз подряд, выводится из пула. Cookies каждой сессии
+сохраняются в свой файл хранилища аккаунтов (vault) через SessionStore
+"""
+import glob
+import itertools
+import os
+import threading
+
+from loguru import logger
+
+from sessionstore import SessionStore
+
+
+class SessionPool:
+    """Сессии requests нескольких аккаунтов с учетом их загрузки и состояния"""
+
+    def __init__(self, max_failures=20):
+        self.max_failures = max_failures  # после стольких страниц без авторизации подряд сессия выводится из пула
+        self._entries = []  # словари session, name, store, active, failures, requests, retired
+        self._order = itertools.count()  # порядок выдачи для распределения по кругу
+        self._lock = threading.Lock()
+
+    def add(self, session, name, store=None):
+        """
+        Добавляет авторизованную сессию аккаунта
+        :param store: SessionStore для сохранения Cookies сессии или None
+        """
+        with self._lock:
+            self._entries.append({'session': session, 'name': name, 'store': store, 'active': 0, 'failures': 0,
+                                  'requests': 0, 'retired': False, 'last': 0})
+
+    def __len__(self):
+        with self._lock:
+            return sum(not entry['retired'] for entry in self._entries)
+
+    def _entry(self, session):
+        for entry in self._entries:
+            if entry['session'] is session:
+                return entry
+        raise KeyError('сессия не из пула')
+
+    def acquire(self):
+        """Наименее загруженная сессия, из одинаково загруженных - давно не выдававшаяся, None если сессий нет"""
+        with self._lock:
+            alive = [entry for entry in self._entries if not entry['retired']]
+            if not alive:
+                return None
+            entry = min(alive, key=lambda item: (item['active'], item['last']))
+            entry['active'] += 1
+            entry['requests'] += 1
+            entry['last'] = next(self._order)
+            return entry['session']
+
+    def release(self, session, auth=None):
+        """
+        Возвращает сессию после запроса
+        :param auth: True - признак авторизации на странице найден, False - не найден,
+                     None - авторизация не проверялась (ошибка сети или кода ответа)
+        """
+        with self._lock:
+            entry = self._entry(session)
+            entry['active'] -= 1
+            if auth:
+                entry['failures'] = 0
+            elif auth is False:
+                entry['failures'] += 1
+                if not entry['retired'] and entry['failures'] >= self.max_failures:
+                    entry['retired'] = True
+                    logger.warning(f'Сессия аккаунта {entry["name"]} выведена из пула после {entry["failures"]} '
+                                   f'страниц без авторизации подряд')
+            store = entry['store']
+        if auth and store is not None:
+            store.save(session)  # запись на диск только при изменении Cookies
+
+    def flush(self):
+        # записывает на диск отложенные изменения Cookies всех сессий
+        with self._lock:
+            stores = [entry['store'] for entry in self._entries if entry['store'] is not None]
+        for store in stores:
+            store.flush()
+
+    def stats(self):
+        with self._lock:
+            return {entry['name']: {'requests': entry['requests'], 'failures': entry['failures'],
+                                    'retired': entry['retired']} for entry in self._entries}
+
+    @staticmethod
+    def load_vault(directory):
+        """
+        Cookies аккаунтов из хранилища: по одному файлу SessionStore name.json на аккаунт
+        :return: список (name, SessionStore, Cookies)
+        """
+        accounts = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            store = SessionStore(path)
+            cookies = store.load()
+            if cookies:
+                accounts.append((os.path.splitext(os.path.basename(path))[0], store, cookies))
+        return accounts
@@ -0,0 +1,78 @@
+"""
+Сохранение Cookies авторизованной сессии на диск.
+Файл перезаписывается только при изменении Cookies и не чаще одного раза в interval секунд.
+Запись атомарная: во временный файл с последующим переименованием, поэтому при аварийном
+завершении на диске остается предыдущая целая версия. Из сохраненных Cookies сессия
+восстанавливается через TrademeParserBot._create_session_cookies
+"""
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+
+class SessionStore:
+    """Файл с Cookies авторизованной сессии, который перезаписывается только при их изменении"""
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval  # минимальный интервал между записями на диск, секунд
+        self._saved = None  # Cookies, записанные на диск последними
+        self._pending = None  # измененные Cookies, еще не записанные на диск
+        self._written = 0  # время последней записи
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _snapshot(session):
+        # Cookies сессии в виде списка словарей для session.cookies.set(**cookie)
+        return sorted(({'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain,
+                        'path': cookie.path, 'secure': cookie.secure, 'expires': cookie.expires}
+                       for cookie in session.cookies), key=lambda cookie: (cookie['domain'], cookie['name']))
+
+    def save(self, session, force=False):
+        """
+        Запоминает Cookies сессии, если они изменились, и записывает их на диск,
+        если с прошлой записи прошло больше interval секунд или force=True
+        """
+        cookies = self._snapshot(session)
+        with self._lock:
+            if cookies == self._saved:
+                self._pending = None
+                return
+            self._pending = cookies
+            if force or time.monotonic() - self._written >= self.interval:
+                self._write()
+
+    def flush(self):
+        """Записывает на диск изменения, отложенные из-за интервала"""
+        with self._lock:
+            if self._pending is not None:
+                self._write()
+
+    def _write(self):
+        temp = self.path + '.tmp'
+        try:
+            with open(temp, 'w', encoding='utf-8') as file:
+                json.dump(self._pending, file, ensure_ascii=False)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.path)
+        except Exception as ex:
+            logger.error(f'Не удалось сохранить Cookies сессии в файл {self.path} {ex}')
+            return
+        self._saved, self._pending = self._pending, None
+        self._written = time.monotonic()
+        logger.success(f'Cookies успешной сессии сохранены в служебный файл {os.path.basename(self.path)}')
+
+    def load(self):
+        """Сохраненные Cookies или None, если файла нет или он поврежден"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                cookies = json.load(file)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._saved = cookies
+        return cookies
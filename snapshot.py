@@ -0,0 +1,107 @@
+"""
+Индекс снимков товаров магазинов для инкрементального повторного парсинга.
+Для каждого номера листинга магазина хранится отпечаток содержимого строки товара,
+номер строки на листе Google-таблицы и время, когда листинг последний раз видели и проверяли.
+В режиме delta страницы товаров открываются только для новых листингов и тех,
+которые пора перепроверить, а изменившиеся строки обновляются на листе на месте
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def fingerprint(row):
+    # отпечаток строки товара без ссылки, которая может отличаться для одного листинга
+    product_id, count, url, title, description, price, price_tag = row
+    content = json.dumps([count, title, description, price, price_tag], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class SnapshotIndex:
+    """Снимки строк товаров по магазинам в файле SQLite"""
+
+    def __init__(self, path, revalidate_after=7 * 24 * 3600):
+        self.path = path
+        self.revalidate_after = revalidate_after  # через сколько секунд листинг нужно проверить повторно
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS snapshot (
+                shop TEXT NOT NULL, listing_id TEXT NOT NULL, fingerprint TEXT NOT NULL,
+                row_number INTEGER, last_seen REAL NOT NULL, last_checked REAL NOT NULL,
+                PRIMARY KEY (shop, listing_id))''')
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def has_rows(self, shop):
+        """Есть ли у магазина строки, уже записанные на лист"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM snapshot WHERE shop = ? AND row_number IS NOT NULL LIMIT 1', (shop,)).fetchone()
+        return row is not None
+
+    def due(self, shop, listing_ids):
+        """
+        Отмечает листинги как увиденные сейчас и возвращает те из них, которые нужно открыть:
+        новые и проверенные раньше, чем revalidate_after секунд назад
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany('UPDATE snapshot SET last_seen = ? WHERE shop = ? AND listing_id = ?',
+                                         [(now, shop, listing_id) for listing_id in listing_ids])
+            fresh = {listing_id for listing_id, in self._connection.execute(
+                'SELECT listing_id FROM snapshot WHERE shop = ? AND last_checked >= ?',
+                (shop, now - self.revalidate_after))}
+        return set(listing_ids) - fresh
+
+    def compare(self, shop, row):
+        """
+        Сравнивает строку товара со снимком. Снимок изменившейся или новой строки не сохраняется:
+        он записывается методами set_row_numbers и mark_updated только после записи строки на лист,
+        иначе при ошибке записи лист остался бы со старой строкой, а снимок считал бы ее актуальной
+        :return: (NEW, CHANGED или UNCHANGED, номер строки на листе или None)
+        """
+        listing_id = row[0]
+        value = fingerprint(row)
+        with self._lock:
+            saved = self._connection.execute(
+                'SELECT fingerprint, row_number FROM snapshot WHERE shop = ? AND listing_id = ?',
+                (shop, listing_id)).fetchone()
+        if saved is None or saved[1] is None:  # строки нет на листе
+            return NEW, None
+        if saved[0] != value:
+            return CHANGED, saved[1]
+        now = time.time()
+        with self._lock, self._connection:  # строка на листе актуальна, листинг проверен
+            self._connection.execute(
+                'UPDATE snapshot SET last_seen = ?, last_checked = ? WHERE shop = ? AND listing_id = ?',
+                (now, now, shop, listing_id))
+        return UNCHANGED, saved[1]
+
+    def set_row_numbers(self, shop, rows, first_row):
+        """Сохраняет снимки строк товаров rows, записанных на лист в строки начиная с first_row"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                '''INSERT INTO snapshot VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (shop, listing_id) DO UPDATE SET fingerprint = excluded.fingerprint,
+                   row_number = excluded.row_number, last_seen = excluded.last_seen,
+                   last_checked = excluded.last_checked''',
+                [(shop, row[0], fingerprint(row), first_row + index, now, now) for index, row in enumerate(rows)])
+
+    def mark_updated(self, shop, rows):
+        """
+        Сохраняет снимки изменившихся строк товаров после их обновления на листе
+        :param rows: список (номер строки листа, строка товара)
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'UPDATE snapshot SET fingerprint = ?, last_seen = ?, last_checked = ? WHERE shop = ? AND listing_id = ?',
+                [(fingerprint(row), now, now, shop, row[0]) for row_number, row in rows])
@@ -0,0 +1,102 @@
+"""
+Потоковая загрузка страниц с остановкой после получения нужных полей.
+Тело ответа читается частями по chunk_size байт и сразу подается в инкрементальный парсер lxml (HTMLPullParser).
+По каждому закончившемуся элементу функция marker сообщает, какие поля уже можно извлечь; когда получены
+все поля required, чтение останавливается, а скрипты, блоки похожих товаров и подвал страницы не загружаются.
+Непрочитанный остаток до drain_limit байт дочитывается без разбора, чтобы соединение вернулось в пул
+keep-alive, больший остаток закрывает соединение. Дерево, построенное при чтении, передается в Page
+и повторно не строится
+"""
+import codecs
+
+import lxml.html
+
+from lxml import etree
+
+CHUNK_SIZE = 16 * 1024  # размер части тела ответа, байт
+DRAIN_LIMIT = 32 * 1024  # непрочитанный остаток, который дочитывается ради повторного использования соединения
+
+
+class PartialResponse:
+    """Ответ requests с прочитанной частью тела и атрибутами, которые используют Page, HTTP-кэш и статистика"""
+
+    def __init__(self, response, content, text, complete, skipped, wire_bytes):
+        self.url = response.url
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.encoding = response.encoding
+        self.raw = response.raw
+        self.ok = response.ok
+        self.content = content  # прочитанная часть тела
+        self.text = text
+        self.complete = complete  # тело прочитано до конца
+        self.skipped = skipped  # байт по сети, не прочитанных из-за остановки, None - неизвестно
+        self.wire_bytes = wire_bytes  # байт тела, полученных по сети, вместе с дочитанным остатком
+
+    def __bool__(self):
+        return self.ok
+
+
+def _wire_bytes(response, default):
+    # байт тела, полученных по сети до распаковки
+    try:
+        return response.raw.tell()
+    except Exception:
+        return default
+
+
+def release(response, drain_limit=DRAIN_LIMIT):
+    """
+    Освобождает соединение ответа, тело которого прочитано не полностью: небольшой остаток дочитывается,
+    и соединение возвращается в пул, иначе соединение закрывается
+    :return: кол-во непрочитанных байт по сети или None, если длина тела неизвестна
+    """
+    length = response.headers.get('Content-Length')
+    skipped = int(length) - _wire_bytes(response, 0) if length and length.isdigit() else None
+    if skipped is None and response.status_code in (204, 304):  # ответ без тела
+        skipped = 0
+    if skipped is not None and skipped <= drain_limit:
+        for _ in response.iter_content(CHUNK_SIZE):
+            pass
+    else:
+        response.close()
+    return skipped
+
+
+def read_until(response, marker, required, chunk_size=CHUNK_SIZE, drain_limit=DRAIN_LIMIT):
+    """
+    Чтение тела ответа с stream=True до получения всех полей required
+    :param marker: функция (закончившийся элемент) -> множество полученных полей или None
+    :param required: множество полей, после получения которых чтение останавливается
+    :return: (PartialResponse, дерево lxml.html прочитанной части или None)
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    parser = etree.HTMLPullParser(events=('end',))
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())  # элементы как у lxml.html.fromstring
+    chunks, texts, seen = [], [], set()
+    complete = True
+    for chunk in response.iter_content(chunk_size):
+        chunks.append(chunk)
+        text = decoder.decode(chunk)
+        texts.append(text)
+        parser.feed(text)
+        for _, element in parser.read_events():
+            fields = marker(element)
+            if fields:
+                seen |= fields
+        if required <= seen:
+            complete = False
+            break
+    skipped = 0
+    if complete:
+        texts.append(decoder.decode(b'', final=True))
+    else:
+        skipped = release(response, drain_limit)
+        complete = skipped == 0  # все поля оказались в последней части тела
+    try:
+        tree = parser.close()
+    except etree.LxmlError:  # пустое тело
+        tree = None
+    content = b''.join(chunks)
+    partial = PartialResponse(response, content, ''.join(texts), complete, skipped, _wire_bytes(response, len(content)))
+    return partial, tree
@@ -1,16 +1,26 @@
 import json
 import os
-import pickle
-import random
 import re
+import threading
 import time
 import requests
 
-from bs4 import BeautifulSoup
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
-from authorization import get_response_selenium
+from extractors import canonical_product_url, extract, extract_product, extraction_stats, product_id, product_links
+from extractors import last_listing_page, listing_page_number, listing_page_url, stream_marker, STREAM_FIELDS
+from frontier import DONE, FAILED
+from metrics import METRICS
+from page import Page
+from ratelimit import HostRateLimiter
+from records import ProductRow
+from retry import RetryQueue, RetryRunner
+from sessionstore import SessionStore
+from snapshot import CHANGED, UNCHANGED
+from streaming import read_until, release
+from transport import Transport
 
 from settings.settings import HEADERS, KEYCOOKIES, FILE_FOR_PARSING
 from settings.settings import URL_CHECK_AUTH, LOGIN_CHECK, URL_SHOP
@@ -25,22 +35,57 @@ class TrademeParserBot:
     #TODO При необходимости можно сделать функцию парсинга из файла
     """
 
-    def __init__(self, cookies=None, session=None, file_for_parsing=None):
+    def __init__(self, cookies=None, session=None, file_for_parsing=None, workers=1, rate_limiter=None,
+                 frontier=None, session_store=None, http_cache=None, snapshot=None, browser_pool=None,
+                 session_pool=None, parser_pool=None, retry_attempts=3, breaker=None, row_cache=None,
+                 profiler=None, transport=None, stream_products=False):
         if cookies is None:
             pass
         else:
             self.cookies = self._edit_cookies(cookies)
+        # транспорт HTTP: пулы соединений, сжатие, кэш DNS и статистика, общий для сессий бота
+        self.transport = transport if transport is not None else Transport(pool_size=max(10, workers))
+        self.headers = self.transport.headers(HEADERS)  # Accept-Encoding только с поддерживаемыми сжатиями
+        # страницы товаров читаются потоково до получения всех полей, для сессий HTTP/2 - целиком
+        self.stream_products = stream_products and not self.transport.http2
         if session is None:
-            self.session = self._create_session_cookies(self.cookies)
+            self.session = self._create_session_cookies(self.cookies, self.transport)
         else:
             self.session = session
+        # пул сессий нескольких аккаунтов, None - все запросы через self.session
+        self.session_pool = session_pool
+        self.parser_pool = parser_pool  # пул процессов разбора страниц товаров, None - разбор в потоках загрузки
+        self.browser_pool = browser_pool  # пул браузеров для страниц без авторизации, None - повторный запрос
+        self.snapshot = snapshot  # индекс снимков товаров для режима delta, None - парсинг всех товаров
+        # (номер строки на листе, строка) изменившихся товаров режима delta, если их некому передать сразу
+        self.changed_products = []
+        self.count_changed = 0  # кол-во изменившихся товаров режима delta
+        self.http_cache = http_cache  # HTTP-кэш страниц для условных запросов, None - без кэша
+        self.row_cache = row_cache  # RowCache строк товаров по номеру листинга, общий для магазинов запуска
+        self.name_shop = None  # магазин, который парсится сейчас, метка метрик
+        self.profiler = profiler  # profiling.Profiler для задач пулов потоков в режиме профилирования
+        self.frontier = frontier  # хранилище состояния очереди парсинга, сохраняет прогресс по каждой ссылке
         if file_for_parsing is None:
             self.data_for_parsing = {}  # словарь для парсинга товаров
+        elif frontier is not None:
+            self.data_for_parsing = frontier.load_all()  # незавершенные магазины из хранилища очереди
         else:
             self.data_for_parsing = self._get_data_for_parsing(file_for_parsing)  # получаем словарь из файла
         self.count_requests = 0  # общий счетчик запросов к сайту
-        self.result_parsing_products = []  # динамический результат парсинга товаров
         self.count_no_auth = 300  # счетчик подсчета открытия страниц без авторизации для завершения парсинга
+        self.workers = workers  # количество одновременных запросов к страницам товаров
+        if rate_limiter is None:
+            # в среднем один запрос в 4 секунды, как и прежняя пауза randrange(3, 6) после каждого запроса
+            self.rate_limiter = HostRateLimiter(rate=0.25)
+        else:
+            self.rate_limiter = rate_limiter  # общий бюджет запросов, может разделяться между ботами
+        self._lock = threading.Lock()  # защита счетчиков при параллельных запросах
+        self.retry_attempts = retry_attempts  # повторы неудачной ссылки в том же запуске с растущей паузой
+        self.breaker = breaker  # CircuitBreaker, приостанавливает запросы при всплеске ошибок, может быть общим
+        if session_store is None:
+            self.session_store = SessionStore(os.getcwd() + '\\pickles\\cookies.json')
+        else:
+            self.session_store = session_store  # Cookies успешной сессии записываются только при изменении
 
     @staticmethod
     def _get_data_for_parsing(file):
@@ -58,19 +103,24 @@ class TrademeParserBot:
         return cookies_selenium
 
     @staticmethod
-    def _create_session_cookies(cookies):
-        # создаем ссесию и добавляем Cookies из selenium
-        session = requests.Session()
+    def _create_session_cookies(cookies, transport=None):
+        # создаем ссесию с настроенным транспортом и добавляем Cookies из selenium
+        session = transport.session() if transport is not None else requests.Session()
         for cookie in cookies:
             session.cookies.set(**cookie)
         return session
 
-    def check_auth(self):
+    def check_auth(self, session=None, session_store=None):
         # проверка авторизации в сессии с помощью Cookies
+        # по умолчанию проверяется self.session, для пула сессий - сессия аккаунта со своим файлом Cookies
+        if session is None:
+            session = self.session
+        if session_store is None:
+            session_store = self.session_store
         logger.info(f'Открываем страницу после авторизации {URL_CHECK_AUTH}')
         try:
             self.count_requests += 1
-            response = self.session.get(URL_CHECK_AUTH, headers=HEADERS, timeout=30)
+            response = session.get(URL_CHECK_AUTH, headers=self.headers, timeout=30)
         except Exception as ex:
             logger.info(f'Ошибка открытия страницы. {ex}')
             return False
@@ -78,20 +128,16 @@ class TrademeParserBot:
         if response.status_code != 200:
             logger.error(f'Ошибка ответа сервера. Код {response.status_code}')
             return False
-        try:
-            soup = BeautifulSoup(response.text, 'lxml')
-            login = soup.find('form', action="/Members/Logout.aspx").text.strip()
-            if login == LOGIN_CHECK:
-                logger.success(f'Авторизация успешна')
-                with open(os.getcwd() + '\\pickles\\session.pickle', 'wb') as file:
-                    pickle.dump(self.session, file)
-                    logger.info(f'Успешная сессия сохранена в служебный файл session.pickle')
-                return True
-            else:
-                logger.error(f'Пользователь на странице {login} не совпал с ключевым словом авторизации {LOGIN_CHECK}')
-                return False
-        except AttributeError as ex:
-            logger.error(f'Ошибка авторизации с использованием Cookies {ex}')
+        login = extract('login', Page.from_response(response))
+        if login is None:
+            logger.error(f'Ошибка авторизации с использованием Cookies, на странице нет признака авторизации')
+            return False
+        if login == LOGIN_CHECK:
+            logger.success(f'Авторизация успешна')
+            session_store.save(session, force=True)
+            return True
+        else:
+            logger.error(f'Пользователь на странице {login} не совпал с ключевым словом авторизации {LOGIN_CHECK}')
             return False
 
     # метод записи в файл json результата парсинга ссылок листинга и ссылок на товары
@@ -117,352 +163,553 @@ class TrademeParserBot:
         except Exception as ex:
             logger.error(f'Не удалось сохранить файл {name_file} диск {ex}')
 
-    def _check_open_url(self, url):
+    @property
+    def current_rate(self):
+        """Текущий темп запросов к сайту, запросов в секунду"""
+        return self.rate_limiter.current_rate(URL_SHOP)
+
+    def _acquire_session(self):
+        # сессия для запроса: наименее загруженная из пула или self.session, None если в пуле не осталось сессий
+        if self.session_pool is None:
+            return self.session
+        return self.session_pool.acquire()
+
+    def _release_session(self, session, auth=None):
+        """
+        возвращает сессию после запроса и сохраняет ее Cookies, если на странице найден признак авторизации
+        :param auth: True, False или None, если авторизация не проверялась
+        """
+        if self.session_pool is None:
+            if auth:
+                self.session_store.save(session)  # запись на диск только при изменении Cookies
+            return
+        self.session_pool.release(session, auth)
+
+    def _flush_sessions(self):
+        # записывает на диск отложенные изменения Cookies
+        self.session_store.flush()
+        if self.session_pool is not None:
+            self.session_pool.flush()
+
+    def _pace_success(self, url, latency):
+        # успешный ответ передаем регулятору темпа запросов
+        self.rate_limiter.success(url, latency)
+        if self.breaker is not None:
+            self.breaker.record(True)
+        logger.debug(f'Ответ за {latency:.2f} c, темп запросов {self.rate_limiter.current_rate(url):.3f} в секунду')
+
+    def _pace_failure(self, url, reason):
+        # ошибку передаем регулятору темпа запросов
+        self.rate_limiter.failure(url, reason)
+        if self.breaker is not None:
+            self.breaker.record(False)
+
+    def _profiled(self, func, name_shop, stage):
+        # в режиме профилирования задачи пула потоков профилируются в потоке выполнения
+        return self.profiler.wrap(func, name_shop, stage) if self.profiler is not None else func
+
+    def _read_streamed(self, response, marker, labels):
+        """
+        чтение ответа с stream=True до получения полей STREAM_FIELDS, размер отсечки пишется в лог и метрики
+        :return: (ответ с прочитанной частью тела, дерево страницы или None)
+        """
+        if response.status_code != 200:
+            release(response)  # соединение возвращается в пул, тело ответа с ошибкой не нужно
+            return response, None
+        response, tree = read_until(response, marker, STREAM_FIELDS)
+        if not response.complete:
+            skipped = response.skipped
+            logger.debug(f'Страница прочитана до получения всех полей: загружено {response.wire_bytes} байт, '
+                         f'не загружено {"неизвестно сколько" if skipped is None else skipped} байт')
+            METRICS.inc('cutoff_pages_total', **labels)
+            if skipped is not None:
+                METRICS.observe('cutoff_bytes', skipped, **labels)
+        return response, tree
+
+    def _check_open_url(self, url, stage=None, marker=None):
         """
-        метод проверки открытия ссылки, возвращает объект response для парсинга, False или 'STOP' в случае ошибки
+        метод проверки открытия ссылки, возвращает объект Page для парсинга, False или 'STOP' в случае ошибки
+        Страница разбирается один раз, разобранное дерево Page.tree используют правила извлечения
         :param url: ссылка для проверки
-        :return: объект response, если авторизация на странице успешна
+        :param stage: этап парсинга 'listing' или 'product', метка метрик
+        :param marker: функция extractors.stream_marker, при self.stream_products страница читается потоково
+                       и загрузка останавливается после получения всех полей STREAM_FIELDS
+        :return: объект Page, если авторизация на странице успешна или страница получена дополнительным запросом
                  False, если страница не открылась, или ключевое слово авторизации не совпало с установленным,
                         или сервер вернул не 200-й код
                  'STOP', если авторизации нет на странице
         """
+        labels = {'shop': self.name_shop, 'stage': stage}
+        start = time.monotonic()
+        if self.breaker is not None:
+            self.breaker.wait()  # при всплеске ошибок запросы приостановлены
+            METRICS.inc('sleep_seconds_total', time.monotonic() - start, reason='breaker', **labels)
+            start = time.monotonic()
+        self.rate_limiter.acquire(url)  # ожидаем свою очередь в общем бюджете запросов к сайту
+        METRICS.inc('sleep_seconds_total', time.monotonic() - start, reason='rate', **labels)
+        session = self._acquire_session()
+        if session is None:
+            logger.error(f'В пуле не осталось авторизованных сессий')
+            with self._lock:
+                self.count_no_auth = 0
+            return 'STOP'
         try:
-            self.count_requests += 1
-            response = self.session.get(url, headers=HEADERS, timeout=30)  # переходим на страницу и получаем ответ
+            with self._lock:
+                self.count_requests += 1
+            headers = self.headers
+            if self.http_cache is not None:
+                headers = dict(self.headers, **self.http_cache.headers(url))  # условный запрос к странице из кэша
+            streamed = marker is not None and self.stream_products
+            tree = None
+            start = time.monotonic()
+            # переходим на страницу и получаем ответ
+            response = session.get(url, headers=headers, timeout=30, stream=streamed)
+            if streamed:
+                response, tree = self._read_streamed(response, marker, labels)
+            latency = time.monotonic() - start
+            METRICS.observe('request_seconds', latency, **labels)
+            METRICS.inc('requests_total', status=response.status_code, **labels)
         except Exception as ex:
+            METRICS.inc('requests_total', status='error', **labels)
             logger.error(f'Ошибка открытия страницы')
             logger.error(f'Код ошибки {ex}')
+            self._release_session(session)
+            self._pace_failure(url, f'ошибка открытия страницы {ex}')
             return False
 
+        if response.status_code == 304 and self.http_cache is not None:
+            # страница не изменилась, авторизация на ней была подтверждена при сохранении в кэш
+            text = self.http_cache.load(url)
+            if text is not None:
+                logger.debug(f'Страница не изменилась, берем ее из HTTP-кэша')
+                self._release_session(session)
+                self._pace_success(url, latency)
+                page = Page(response.url, text, auth='cache', response=response)
+                page.cached = True
+                return page
+
         if response.status_code != 200:
             logger.error(f'Ошибка ответа сервера. Код {response.status_code}')
+            self._release_session(session)
+            self._pace_failure(url, f'код ответа сервера {response.status_code}')
             return False
 
-        soup = BeautifulSoup(response.text, 'lxml')
-
-        try:
-            login = soup.find('form', action="/Members/Logout.aspx").text.strip()  # ищем признак авторизации
+        METRICS.observe('response_bytes', len(response.content), **labels)
+        self.transport.record(response)
+        with METRICS.timer('parse_seconds', **labels):  # дерево страницы строится при поиске признака авторизации
+            page = Page.from_response(response, tree=tree)
+            login = extract('login', page)  # ищем признак авторизации
+        if login is not None:
             if login == LOGIN_CHECK:
                 logger.success(f'Авторизация на текущей странице подтверждена')
-                with open(os.getcwd() + '\\pickles\\session.pickle', 'wb') as file:
-                    pickle.dump(self.session, file)
-                    logger.success(f'Успешная сессия сохранена в служебный файл session.pickle')
-                return response
+                self._release_session(session, auth=True)
+                self._pace_success(url, latency)
+                page.auth = 'login'
+                if self.http_cache is not None:
+                    page.cached = not self.http_cache.store(url, response)
+                return page
             else:
                 logger.error(f'Пользователь на странице {login} не совпал с ключевым словом авторизации {LOGIN_CHECK}')
+                self._release_session(session, auth=False)
+                self._pace_failure(url, f'ключевое слово авторизации не совпало')
                 return False
-        except AttributeError:
-            # дополнительная проверка на наличие авторизации при парсинге товаров без LOGIN_CHECK
-            try:
-                if soup.select_one('a.logged-in__log-out').text.strip() == 'Log out':
-                    logger.debug(f'Страница без параметра LOGIN_CHECK')
-                    return response
-            except AttributeError as ex:
-                try:
-                    logger.debug(f'Ошибка авторизации на текущей странице {ex}')
-                    logger.info(f'Делаем дополнительный запрос на сайт')
+
+        # дополнительная проверка на наличие авторизации при парсинге товаров без LOGIN_CHECK
+        if extract('logout', page) == 'Log out':
+            logger.debug(f'Страница без параметра LOGIN_CHECK')
+            self._release_session(session, auth=True)
+            self._pace_success(url, latency)
+            page.auth = 'logout'
+            if self.http_cache is not None:
+                page.cached = not self.http_cache.store(url, response)
+            return page
+
+        # страница без признака авторизации - признак того, что сайт ограничивает частоту запросов
+        # или что сессия аккаунта больше не действует
+        self._release_session(session, auth=False)
+        self._pace_failure(url, f'страница без признака авторизации')
+        try:
+            logger.debug(f'Ошибка авторизации на текущей странице')
+            logger.info(f'Делаем дополнительный запрос на сайт')
+            with self._lock:
+                if self.session_pool is None:
                     self.count_no_auth -= 1  # увеличиваем счетчик найденных страниц без авторизации
-                    logger.debug(f'Осталось попыток открытия страниц без авторизации {self.count_no_auth}')
-                    # возвращаем ответ без параметра headers (с ним проблемы с кодировкой)
-                    self.count_requests += 1
-
-                    # возможный вариант получения в режиме имитации действий в браузере
-                    # требует корректировки кода, т.к. response не имеет атрибута text
-                    # response = get_response_selenium(url=url, session=self.session)
-
-                    response = self.session.get(url, timeout=30)
-                    if response.status_code == 200:
-                        return response
-                    else:
-                        return 'STOP'
-                except Exception as ex:
-                    logger.exception(f'Ошибка при дополнительном запросе на сайт {ex}')
-                    return 'STOP'
-
-    def parsing_products(self, name_shop):
+                elif not len(self.session_pool):
+                    self.count_no_auth = 0  # все сессии пула выведены из работы
+                self.count_requests += 1
+            logger.debug(f'Осталось попыток открытия страниц без авторизации {self.count_no_auth}')
+            METRICS.inc('auth_fallback_total', via='browser' if self.browser_pool is not None else 'request',
+                        **labels)
+            start = time.monotonic()
+            self.rate_limiter.acquire(url)
+            METRICS.inc('sleep_seconds_total', time.monotonic() - start, reason='rate', **labels)
+
+            if self.browser_pool is not None:
+                # страница в режиме имитации действий в браузере из пула браузеров с Cookies сессии
+                return self._open_url_browser(url)
+
+            # раньше дополнительный запрос отправлялся без headers: в них мог быть Accept-Encoding br,
+            # который requests без brotli не распаковывает, self.headers содержат только поддерживаемые сжатия
+            # с пулом сессий дополнительный запрос делается через другую наименее загруженную сессию
+            session = self._acquire_session()
+            if session is None:
+                return 'STOP'
+            try:
+                response = session.get(url, headers=self.headers, timeout=30)
+            finally:
+                self._release_session(session)
+            if response.status_code == 200:
+                return Page.from_response(response)
+            else:
+                return 'STOP'
+        except Exception as ex:
+            logger.exception(f'Ошибка при дополнительном запросе на сайт {ex}')
+            return 'STOP'
+
+    def _open_url_browser(self, url):
         """
-        метод парсинга товаров
-        :return: self.result_parsing_products
+        получение страницы в браузере пула self.browser_pool
+        :return: объект Page, если на странице есть признак авторизации, иначе 'STOP'
         """
+        text = self.browser_pool.get(url)
+        if text is None:
+            return 'STOP'
+        page = Page(url, text)
+        if extract('login', page) == LOGIN_CHECK or extract('logout', page) == 'Log out':
+            logger.debug(f'Страница получена в браузере')
+            page.auth = 'browser'
+            return page
+        logger.debug(f'В браузере страница тоже без признака авторизации')
+        return 'STOP'
+
+    def parse_product(self, url_product, count_product):
+        """
+        парсинг одной страницы товара, выполняется в потоках пула или на узле распределенного парсинга
+        :return: строка [id, count, url, title, description, price, price_tag], False или 'STOP' в случае ошибки
+        """
+        if self.row_cache is None:
+            return self._load_product(url_product, count_product)
+        # листинг, уже спарсенный в этом запуске под любой ссылкой и в любом магазине, не запрашивается
+        return self.row_cache.fetch(product_id(url_product), count_product,
+                                    lambda: self._load_product(url_product, count_product))
+
+    def _load_product(self, url_product, count_product):
+        # открытие и парсинг страницы товара
+        logger.info(f' Открываем ссылку товара {URL_SHOP + url_product}')
+        listing_id = product_id(url_product)
+        # проверка авторизации на странице, страница загружается до получения полей товара
+        page = self._check_open_url(URL_SHOP + url_product, 'product', stream_marker(listing_id))
+        if not page or page == 'STOP':
+            return page
+
+        product_count = int(count_product)
+        product_url = page.url
+        # неизмененная страница не парсится, поля товара берутся из HTTP-кэша
+        fields = None
+        if page.cached:
+            fields = self.http_cache.get_meta(URL_SHOP + url_product)
+        if fields is None:
+            # поля товара из встроенного JSON страницы или правилами extractors.FIELDS по дереву страницы
+            with METRICS.timer('extract_seconds', shop=self.name_shop, stage='product'):
+                # страница, разобранная при потоковой загрузке, в процесс пула не передается, иначе она
+                # разбиралась бы дважды, правила извлечения применяются к готовому дереву
+                if self.parser_pool is not None and not page.streamed:
+                    fields = self.parser_pool.parse_product(page, listing_id)  # разбор в отдельном процессе
+                else:
+                    fields = extract_product(page, listing_id)
+            if self.http_cache is not None:
+                self.http_cache.set_meta(URL_SHOP + url_product, fields)
+        product_title = fields['title']
+        product_description = fields['description']
+        product_price = fields['price']
+        product_price_tag = fields['price_tag']
+        logger.debug(f'{listing_id}, {product_count}, {product_title}, '
+                     f'{"description" if product_description else False},'
+                     f' {product_price}, {product_price_tag}')
+        return ProductRow.make([listing_id, product_count, product_url, product_title,
+                                product_description, product_price, product_price_tag])
+
+    def get_urls_products(self, page, url):
+        """
+        получение на странице листинга всех ссылок на товары
+        :type page: object Page
+        :param url: ссылка, под которой страница сохранена в HTTP-кэше
+        :return: Counter ссылка на товар в едином виде - кол-во на странице
+        """
+        links = None
+        if page.cached:  # неизмененная страница не парсится, ссылки берутся из HTTP-кэша
+            links = self.http_cache.get_meta(url)
+        if links is None:
+            with METRICS.timer('extract_seconds', shop=self.name_shop, stage='listing'):
+                links = product_links(page)
+            if self.http_cache is not None:
+                self.http_cache.set_meta(url, links)
+        # один листинг под ссылками разного вида считается одним товаром
+        return Counter(canonical_product_url(link) for link in links)
+
+    def parse_listing(self, listing):
+        """
+        парсинг одной страницы листинга, выполняется в потоках пула или на узле распределенного парсинга
+        :return: (объект Page, False или 'STOP'; Counter ссылок на товары; наибольший номер страницы в пагинации)
+        """
+        logger.info(f'Переходим на страницу {listing}')
+        page = self._check_open_url(URL_SHOP + listing, 'listing')  # проверка авторизации на странице
+        if not page or page == 'STOP':
+            return page, None, 1
+        return page, self.get_urls_products(page, URL_SHOP + listing), last_listing_page(page)
 
-        # функция получения описания товара, используя различную структуру возможных html-страниц товара
-        def _get_description(s):
-            # вариант 1
-            try:
-                html = s.find('div', id=re.compile('\w+ContentBoxdescription'))
-                description = ''
-                for string in html.stripped_strings:
-                    description += string + '\n'
-                return description
-            except AttributeError:
-                pass
-
-            # вариант 2
-            try:
-                html = s.find('div', class_='tm-markdown')
-                description = ''
-                for string in html.stripped_strings:
-                    description += string + '\n'
-                return description
-            except AttributeError:
-                pass
-
-            logger.error(f'Ни один из вариантов парсинга description не найден')
-            return ''
-
-        # функция получения цены товара, используя различную структуру возможных html-страниц товара
-        def _get_price(s, text):
-            # вариант 1
-            try:
-                price = s.find('div', id='BuyNow_BuyNow').text
-                price = price.replace(',', '')
-                price = float(re.search('\d+.\d+', price).group(0))
-                return price
-            except AttributeError:
-                pass
-
-            # вариант 2
-            try:
-                price = s.find('p', class_='tm-buy-now-box__price p-h1').text
-                price = price.replace(',', '')
-                price = float(re.search('\d+.\d+', price).group(0))
-                return price
-            except AttributeError:
-                pass
-
-            # вариант, который получает цену из dict в html, даже если цена скрыта
-            try:
-                price = re.search('\"buyNowPrice\": \d+.\d+', text)
-                price = re.search('\d+.\d+', price.group(0))
-                price = float(price.group(0))
-                return price
-            except AttributeError:
-                pass
-
-            logger.info(f'Ни один из вариантов парсинга price не найден')
-            return 0
-
-        # функция получения признака цены
-        def _get_price_tag(s):
-            # вариант пока единственный
-            try:
-                price_tag = s.find('span', class_='tm-buy-now-box__label').text
-                return price_tag
-            except AttributeError:
-                pass
-
-            logger.info(f'Ни один из вариантов парсинга price_tag не найден')
-            return ''
+    def iter_products(self, name_shop, on_changed=None):
+        """
+        генератор парсинга товаров, отдает строки товаров по мере получения,
+        не накапливая их в памяти. Используется для потоковой записи в Google-таблицу
+        В режиме delta (задан self.snapshot) открываются только новые листинги и те, которые пора
+        перепроверить, отдаются только новые строки, изменившиеся передаются в on_changed
+        :param on_changed: функция (номер строки на листе, строка), например SheetUploader.update,
+                           None - изменившиеся строки собираются в self.changed_products
+        :return: строки [id, count, url, title, description, price, price_tag]
+        """
 
         logger.info(f'Начинаем парсинг товаров магазина "{name_shop}"')
-        # обнуляем список списков с результатом парсинга страниц товаров магазина для загрузки в Google-таблицы
-        self.result_parsing_products = []
+        self.name_shop = name_shop
+        logger.info(f'Одновременных запросов {self.workers}, темп ограничен общим бюджетом запросов к сайту')
+        count_rows = 0  # кол-во полученных строк товаров
         # получаем список ссылок на продукты магазина
         products = self.data_for_parsing[name_shop]['products'].copy()  # получаем список ссылок на продукты магазина
-
-        for url_product, count_product in products.items():
-            logger.info(f'Пауза перед началом парсинга')
-            time.sleep(random.randrange(3, 6))
-            logger.info(f' Открываем ссылку товара {URL_SHOP + url_product}')
-            response = self._check_open_url(URL_SHOP + url_product)  # проверка авторизации на странице
-            if not response:
-                logger.warning(f'Из-за ошибки пропускаем парсинг товара')
-                logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-                # TODO возможно нужен алгоритм подсчета кол-ва ошибок и выхода из скрипта при необходимости
-                continue
-            if response == 'STOP':  # авторизация не успешна
-                if self.count_no_auth <= 0:  # проверяем счетчик открытия страниц без авторизации
-                    logger.warning(f'Из ошибки авторизации прекращаем парсинг')
-                    logger.warning(f'Сохраняем неспарсенные ссылки на товары в файл {name_shop}.json')
-                    self.save_data_for_parsing_file(name_shop)
-                    self.data_for_parsing = {}  # очищаем словарь для парсинга нового магазина
-                    raise  # завершаем парсинг магазина и переходим к следующему
-                else:
-                    logger.warning(f'Из-за ошибки авторизации пропускаем парсинг товара')
-                    logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-                    continue
-
-            soup = BeautifulSoup(response.text, 'lxml')
-
-            product_id = re.search('[0-9]+', url_product).group(0)
-            product_count = int(count_product)
-            product_url = response.url
-            product_title = soup.find('h1').text.strip()
-            product_description = _get_description(soup)
-            product_price = _get_price(soup, response.text)
-            product_price_tag = _get_price_tag(soup)
-            logger.debug(f'{product_id}, {product_count}, {product_title}, '
-                         f'{"description" if product_description else False},'
-                         f' {product_price}, {product_price_tag}')
-            # добавляем результат парсинга в список для загрузки в Google-таблицу
-            self.result_parsing_products.append([product_id, product_count, product_url,
-                                                 product_title, product_description,
-                                                 product_price, product_price_tag])
-
-            # в случае успеха парсинга удаляю из словаря ссылку на товар и перезаписываю файл
-            # data_for_parsing.json, т.е. после завершения парсинга товаров в файле не будет ссылок на товары,
-            # в противном случае останутся неспарсенные товары и можно запустить процедуру парсинга из файла
-            self.data_for_parsing[name_shop]['products'].pop(url_product, False)
-
-            # секция для тестирования
-            # if self.count_requests > 3:
-            #     logger.success(f'Парсинг товаров магазина {name_shop} успешно завершен')
-            #     logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-            #     self.save_data_for_parsing_file(name_shop)
-            #     self.data_for_parsing = {}
-            #     self.count_requests = 0
-            #     logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-            #     return
+        self.changed_products = []
+        self.count_changed = 0
+        if self.snapshot is not None:
+            products = self._select_due_products(name_shop, products)
+
+        # паузы между запросами больше не нужны, темп задает self.rate_limiter
+        # неудачные ссылки повторяются с растущей паузой в этом же запуске, а не при допарсинге
+        retries = RetryQueue(max_attempts=self.retry_attempts)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            runner = RetryRunner(executor, self._profiled(self.parse_product, name_shop, 'products'), retries)
+            for url_product, count_product in products.items():
+                runner.submit(url_product, count_product)
+            try:
+                for url_product, count_product, result in runner.results():
+                    if not result and self.frontier is not None:
+                        self.frontier.set_product_state(name_shop, url_product, FAILED)
+                    if not result:
+                        logger.warning(f'Из-за ошибки пропускаем парсинг товара, попытки исчерпаны')
+                        logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
+                        continue
+                    if result == 'STOP':  # авторизация не успешна
+                        if self.count_no_auth <= 0:  # проверяем счетчик открытия страниц без авторизации
+                            logger.warning(f'Из ошибки авторизации прекращаем парсинг')
+                            logger.warning(f'Сохраняем неспарсенные ссылки на товары в файл {name_shop}.json')
+                            self.save_data_for_parsing_file(name_shop)
+                            self.data_for_parsing = {}  # очищаем словарь для парсинга нового магазина
+                            raise  # завершаем парсинг магазина и переходим к следующему
+                        else:
+                            logger.warning(f'Из-за ошибки авторизации пропускаем парсинг товара')
+                            logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
+                            continue
+
+                    if self._is_new_row(name_shop, result, on_changed):
+                        count_rows += 1
+                        yield result
+
+                    # в случае успеха парсинга удаляю из словаря ссылку на товар и перезаписываю файл
+                    # data_for_parsing.json, т.е. после завершения парсинга товаров в файле не будет ссылок на товары,
+                    # в противном случае останутся неспарсенные товары и можно запустить процедуру парсинга из файла
+                    self.data_for_parsing[name_shop]['products'].pop(url_product, False)
+                    if self.frontier is not None:
+                        self.frontier.set_product_state(name_shop, url_product, DONE)
+            finally:
+                runner.cancel()
 
         logger.success(f'Парсинг товаров магазина {name_shop} успешно завершен.')
-        logger.info(f'Получено товаров {len(self.result_parsing_products)}')
+        if self.snapshot is not None:
+            logger.info(f'Изменилось товаров {self.count_changed}')
+        logger.info(f'Текущий темп запросов к сайту {self.current_rate:.3f} в секунду')
+        logger.debug(f'Доли срабатывания правил извлечения {extraction_stats()}')
+        logger.info(f'Получено товаров {count_rows}, повторных попыток {sum(retries.attempts.values())}')
+        if self.http_cache is not None:
+            logger.info(f'Статистика HTTP-кэша {self.http_cache.stats()}')
+        if self.row_cache is not None:
+            logger.info(f'Статистика кэша строк товаров {self.row_cache.stats()}')
+        logger.info(f'Статистика соединений и сжатия {self.transport.stats()}')
+        self._flush_sessions()
         self.save_data_for_parsing_file(name_shop)
         self.data_for_parsing = {}  # очищаем словарь для парсинга нового магазина
 
+    def _select_due_products(self, name_shop, products):
+        """
+        режим delta: оставляет ссылки на новые листинги и на те, которые пора перепроверить,
+        остальные ссылки считаются спарсенными
+        """
+        ids = {url_product: product_id(url_product) for url_product in products}
+        due = self.snapshot.due(name_shop, list(ids.values()))
+        for url_product in products:
+            if ids[url_product] not in due:
+                self.data_for_parsing[name_shop]['products'].pop(url_product, False)
+                if self.frontier is not None:
+                    self.frontier.set_product_state(name_shop, url_product, DONE)
+        logger.info(f'Режим delta: из {len(products)} товаров открываем {len(due)} новых или устаревших')
+        return {url_product: count for url_product, count in products.items() if ids[url_product] in due}
+
+    def _is_new_row(self, name_shop, row, on_changed=None):
+        """
+        режим delta: сравнивает строку со снимком, изменившуюся строку с известным номером на листе
+        передает в on_changed или, если он не задан, добавляет в self.changed_products
+        :return: True, если строку нужно дописать на лист
+        """
+        if self.snapshot is None:
+            return True
+        state, row_number = self.snapshot.compare(name_shop, row)
+        if state == UNCHANGED:
+            return False
+        if state == CHANGED:
+            with self._lock:
+                self.count_changed += 1
+            if on_changed is not None:
+                on_changed(row_number, row)
+            else:
+                self.changed_products.append((row_number, row))
+            return False
+        return True
+
     def parsing_shop(self, shop):
         """
         Метод парсинга страниц листинга магазина и его товаров.
-        В результате выполнения сохраняется информация в файл data_for_parsing.json
+        Диапазон страниц листинга определяется по первой странице: добавляются все страницы с 1 по наибольший
+        номер в ссылках пагинации, а страницы с большими номерами, найденные на других страницах, дописываются
+        в очередь по мере получения. Страницы открываются одновременно в self.workers потоках в общем бюджете
+        запросов self.rate_limiter, ссылки на товары добавляются в Counter по мере получения страниц.
+        В результате выполнения сохраняется информация в файл data_for_parsing.json,
+        состояние каждой страницы листинга сохраняется в self.frontier по мере парсинга
         :param shop: Список из Наименования магазина и ссылки на первую страницу листинга
                     или строка Наименования магазина при допарсинге из файла
         :return: сохраняет результат парсинга в словарь self.data_for_parsing и в файл data_for_parsing.json
         """
-        def _get_urls_products(s):
-            """
-            функция получения на странице всех ссылок на товары
-            :type s: object Soup
-            """
-            tag_products = s.find_all('a', href=re.compile('\/Browse\/Listing\.aspx\?id=\d+'))
-            for tag in tag_products:
-                products.append(tag.get('href'))
-
-        logger.info(f'Пауза перед началом парсинга')
-        time.sleep(random.randrange(15, 30))
+        # фиксированные паузы не используются, темп запросов задает self.rate_limiter по ответам сервера
 
         # для тестирования
         # self.count_requests = 0
 
-        products = []  # список ссылок на товары одного магазина
+        products = Counter()  # ссылки на товары одного магазина и кол-во их упоминаний на страницах листинга
+        first_listing = None  # ссылка на первую страницу листинга для построения ссылок на остальные страницы
 
         # обычный режим скрипта
         if not FILE_FOR_PARSING:
-            urls_listing = set()  # множество уникальных ссылок страниц магазина с товарами
             name_shop = shop[0].strip('\r')  # Наименование магазина
             url_shop = shop[1]  # ссылка на листинг магазина
+            self.name_shop = name_shop
 
             logger.info(f'Начинаем парсинг листинга магазина "{name_shop}"')
             logger.info(f' Открываем ссылку магазина {url_shop}')
 
-            response = self._check_open_url(url_shop)  # проверка авторизации на странице
-            if not response:
+            page = self._check_open_url(url_shop, 'listing')  # проверка авторизации на странице
+            if not page:
                 logger.warning(f'Из-за ошибки пропускаем парсинг листинга магазина "{name_shop}"')
                 logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
                 return
-            if response == 'STOP':  # авторизация не успешна, завершаем работу скрипта
+            if page == 'STOP':  # авторизация не успешна, завершаем работу скрипта
                 logger.warning(f'Сохраняем имеющиеся результаты в файл {name_shop}.json')
                 self.save_data_for_parsing_file(name_shop)
                 raise  # завершаем работу скрипта
 
-            try:
-                soup = BeautifulSoup(response.text, 'lxml')
-            except AttributeError as ex:
-                soup = BeautifulSoup(response, 'lxml')  # если response уже в виде текста
-                # logger.exception(f'{ex}')
-
             # with open(os.getcwd() + '\\shops\\shop.html', 'w', encoding='utf-8') as file:
-            #     file.write(response.text)
-
-            urls_listing.add(response.url.replace(URL_SHOP, '') + '&type=&page=1')  # текущий адрес страницы добавили в список
-
-            logger.info(f'Получаем все ссылки на страницы листинга')
-            # tag_listing = set(soup.find_all('a', href=re.compile('\/stores\/.+\/feedback\?page=\d+')))
-            tag_listing = set(
-                soup.find_all('a', href=re.compile('Feedback\.aspx\?member=\d+&type=&page=\d+')))
+            #     file.write(page.text)
 
-            for tag in tag_listing:
-                urls_listing.add('/Members/' + tag.get('href'))
+            first_listing = page.url.replace(URL_SHOP, '') + '&type=&page=1'  # текущий адрес страницы
+            last_page = last_listing_page(page)
+            logger.info(f'Страниц листинга по ссылкам первой страницы {last_page}')
+            # первая страница уже получена, повторно она не открывается
+            urls_listing = [listing_page_url(first_listing, number) for number in range(2, last_page + 1)]
+            page_products = self.get_urls_products(page, url_shop)
+            products.update(page_products)
 
             self.data_for_parsing[name_shop] = {}
-            self.data_for_parsing[name_shop]['url-listing'] = list(urls_listing)
-            # сортируем список по номеру страницы
-            self.data_for_parsing[name_shop]['url-listing'].\
-                sort(key=lambda url: int(re.search('\d+', re.search('&page=\d+', url).group(0)).group(0)))
-            self.data_for_parsing[name_shop]['products'] = dict(Counter(products))
+            self.data_for_parsing[name_shop]['url-listing'] = urls_listing
+            self.data_for_parsing[name_shop]['products'] = dict(products)
+            if self.frontier is not None:
+                self.frontier.reset_shop(name_shop)
+                self.frontier.add_listing(name_shop, [first_listing] + urls_listing)
+                self.frontier.complete_listing(name_shop, first_listing, page_products)
 
         # режим работы допарсинга из файла
         else:
             name_shop = shop
-            # получаем неспарсенные ссылки на товары и преобразуем в список
-            products = list(self.data_for_parsing[name_shop]['products'].keys())
+            self.name_shop = name_shop
+            # получаем неспарсенные ссылки на товары вместе с кол-вом
+            products = Counter(self.data_for_parsing[name_shop]['products'])
 
         logger.info(f'Переходим по страницам листинга и получаем ссылки на товары')
-        # создаем копию списка для перебора, чтобы можно было перебирать и применять метод pop() в конце цикла
-        urls = self.data_for_parsing[name_shop]['url-listing'].copy()
-        # счетчик удаления спарсенных ссылок из списка, необходим для правильного определения индекса элемента
-        # для удаления элемента, т.к. в цикле есть конструкция continue
-        count_pop = 0
-        for index, listing in enumerate(urls):
-            logger.info(f'Переходим на страницу {listing}')
-            response = self._check_open_url(URL_SHOP + listing)  # проверка авторизации на странице
-
-            if not response:
-                logger.warning(f'Из-за ошибки пропускаем парсинг страницы')
-                logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-                # TODO возможно нужен алгоритм подсчета кол-ва ошибок и выхода из скрипта при необходимости
-                continue
-            if response == 'STOP':  # авторизация не успешна
-                if self.count_no_auth <= 0:
-                    logger.warning(f'Из ошибки авторизации прекращаем парсинг')
-                    logger.warning(f'Сохраняем имеющиеся результаты в файл {name_shop}.json')
-                    self.save_data_for_parsing_file(name_shop)
-                    raise  # завершаем работу скрипта
-                else:
-                    logger.warning(f'Из-за ошибки авторизации пропускаем парсинг страницы')
-                    logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-                    continue  # пропускаем парсинг страницы и продолжаем цикл
-
+        urls = self.data_for_parsing[name_shop]['url-listing']
+        known_pages = {listing_page_number(listing) for listing in urls} | {1}
+        # неудачные страницы повторяются с растущей паузой в этом же запуске
+        retries = RetryQueue(max_attempts=self.retry_attempts)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            load = self._profiled(lambda listing, payload: self.parse_listing(listing), name_shop, 'listing')
+            runner = RetryRunner(executor, load, retries, failed=lambda result: not result or not result[0])
+            for listing in list(urls):
+                runner.submit(listing)
             try:
-                soup = BeautifulSoup(response.text, 'lxml')
-            except AttributeError as ex:
-                soup = BeautifulSoup(response, 'lxml')  # если response уже в виде текста
-                # logger.exception(f'{ex}')
-
-            # получаем ссылки на товары на странице листинга и добавляем в кортеж
-            _get_urls_products(soup)
-            logger.info(f'Ссылки для парсинга товаров получены')
-
-            self.data_for_parsing[name_shop]['products'] = dict(Counter(products))
-
-            # в случае удачного парсинга ссылок на товары, удаляем ссылку из словаря
-            # по окончанию парсинга в словаре не должно остаться страниц с листингами
-            # в противном случае данные ссылок на товары не были получены на оставшихся страницах
-            self.data_for_parsing[name_shop]['url-listing'].pop(index - count_pop)
-            count_pop += 1  # увеличиваем счетчик удаления элементов
-
-            time.sleep(random.randrange(3, 6))
-
-            # секция для тестирования
-            # if self.count_requests > 3:
-            #     count_products = len(self.data_for_parsing[name_shop]['products'])
-            #     logger.success(f'Получено {count_products} ссылки на товары в магазине "{name_shop}"')
-            #     logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-            #     self.save_data_for_parsing_file(name_shop)  # записываем результат парсинга в файл
-            #     self.count_requests = 0
-            #     logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
-            #     return
-
+                for listing, payload, result in runner.results():
+                    page, page_products, last_page = result or (False, None, 1)
+
+                    if not page and self.frontier is not None:
+                        self.frontier.set_listing_state(name_shop, listing, FAILED)
+                    if not page:
+                        logger.warning(f'Из-за ошибки пропускаем парсинг страницы, попытки исчерпаны')
+                        logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
+                        continue
+                    if page == 'STOP':  # авторизация не успешна
+                        if self.count_no_auth <= 0:
+                            logger.warning(f'Из ошибки авторизации прекращаем парсинг')
+                            logger.warning(f'Сохраняем имеющиеся результаты в файл {name_shop}.json')
+                            self.save_data_for_parsing_file(name_shop)
+                            raise  # завершаем работу скрипта
+                        else:
+                            logger.warning(f'Из-за ошибки авторизации пропускаем парсинг страницы')
+                            logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
+                            continue  # пропускаем парсинг страницы и продолжаем цикл
+
+                    products.update(page_products)
+                    logger.info(f'Ссылки для парсинга товаров получены')
+                    self.data_for_parsing[name_shop]['products'] = dict(products)
+                    # в случае удачного парсинга ссылок на товары, удаляем ссылку из списка
+                    # по окончанию парсинга в списке не должно остаться страниц с листингами
+                    # в противном случае данные ссылок на товары не были получены на оставшихся страницах
+                    urls.remove(listing)
+
+                    # на больших магазинах пагинация показывает не все страницы, новые дописываются в очередь
+                    # при допарсинге из файла спарсенные страницы неизвестны, поэтому новые не ищутся
+                    new_urls = []
+                    if first_listing is not None and last_page > max(known_pages):
+                        new_urls = [listing_page_url(first_listing, number)
+                                    for number in range(max(known_pages) + 1, last_page + 1)]
+                        known_pages.update(range(max(known_pages) + 1, last_page + 1))
+                        logger.info(f'Найдено новых страниц листинга {len(new_urls)}')
+                        urls.extend(new_urls)
+                    if self.frontier is not None:
+                        # страница и ее товары сохраняются в хранилище сразу, без перезаписи всего файла
+                        self.frontier.add_listing(name_shop, new_urls)
+                        self.frontier.complete_listing(name_shop, listing, page_products)
+                    for new_listing in new_urls:
+                        runner.submit(new_listing)
+            finally:
+                runner.cancel()
+
+        urls.sort(key=listing_page_number)  # незавершенные страницы по порядку номеров
         count_products = len(self.data_for_parsing[name_shop]['products'])  # кол-во уникальных товаров
         logger.success(f'Получено {count_products} ссылки на товары в магазине "{name_shop}"')
         logger.debug(f'Счетчик запросов к сайту {self.count_requests}')
+        if self.http_cache is not None:
+            logger.info(f'Статистика HTTP-кэша {self.http_cache.stats()}')
 
         self.save_data_for_parsing_file(name_shop)  # записываем результат парсинга в файл
+        self._flush_sessions()
 
 
 if __name__ == '__main__':
     pass
 
-    # with open(os.getcwd() + '\\pickles\\session.pickle', 'rb') as file:
-    #     session = pickle.load(file)
+    # cookies = SessionStore(os.getcwd() + '\\pickles\\cookies.json').load()
+    # session = TrademeParserBot._create_session_cookies(cookies)
     #
     # url = 'https://www.trademe.co.nz/Browse/Listing.aspx?id=2961967160'
     # url = 'https://www.trademe.co.nz/a/motors/car-parts-accessories/radar-detectors/listing/2961967160?bof=NGey1jYX'
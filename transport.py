@@ -0,0 +1,239 @@
+"""
+Настроенный транспорт HTTP для сессий парсера.
+Все сессии одного Transport используют пулы соединений размера pool_size (не меньше общего кол-ва
+одновременных запросов, иначе лишние соединения закрываются и каждый раз заново проходят TLS-рукопожатие),
+keep-alive, повтор только при ошибке установки соединения (ответы сервера обрабатывает регулятор темпа
+и очередь повторов), Accept-Encoding только с теми сжатиями, которые можно распаковать (br - при установленном
+brotli), и кэш DNS на dns_ttl секунд. Кэш DNS используется только соединениями пулов сессий Transport,
+socket.getaddrinfo процесса (Google API, selenium, очередь задач) не меняется. При http2=True сессии создаются
+на httpx с HTTP/2: одновременные запросы идут по одному соединению, кэш DNS для них не используется.
+Статистика показывает долю запросов по уже открытым соединениям и степень сжатия
+"""
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+try:
+    import brotli  # noqa: F401 - urllib3 распаковывает br, если установлен brotli
+    ENCODINGS = 'gzip, deflate, br'
+except ImportError:
+    ENCODINGS = 'gzip, deflate'
+
+
+class DnsCache:
+    """
+    Кэш адресов сайтов на ttl секунд для соединений пулов Transport.
+    Устаревшие записи удаляются при обращении, кэш хранит не больше max_entries адресов
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # (хост, порт) - (время получения, адреса)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """IP-адреса хоста из кэша или socket.getaddrinfo"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+            self._cache.pop(key, None)  # устаревшая запись
+        addresses = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)))
+        with self._lock:
+            self._cache[key] = (now, addresses)
+            self.misses += 1
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return addresses
+
+
+def _cached_connection(base, dns):
+    # класс соединения urllib3, который подключается к адресам хоста из dns, проверка сертификата
+    # и SNI по-прежнему используют имя хоста self.host
+    class CachedDnsConnection(base):
+        def _new_conn(self):
+            host = self._dns_host
+            addresses = dns.resolve(host, self.port)
+            try:
+                for index, address in enumerate(addresses):
+                    self._dns_host = address
+                    try:
+                        return super()._new_conn()
+                    except Exception:
+                        if index == len(addresses) - 1:
+                            raise
+            finally:
+                self._dns_host = host
+    return CachedDnsConnection
+
+
+class CachedDnsAdapter(HTTPAdapter):
+    """HTTPAdapter, пулы соединений которого берут адреса сайтов из DnsCache"""
+
+    def __init__(self, dns, **kwargs):
+        self.dns = dns
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('CachedDnsHTTPConnectionPool', (HTTPConnectionPool,),
+                         {'ConnectionCls': _cached_connection(HTTPConnection, self.dns)}),
+            'https': type('CachedDnsHTTPSConnectionPool', (HTTPSConnectionPool,),
+                          {'ConnectionCls': _cached_connection(HTTPSConnection, self.dns)}),
+        }
+
+    def __setstate__(self, state):
+        # адаптер восстанавливается из pickle без dns, кэш создается заново
+        self.dns = state.pop('dns', None) or DnsCache()
+        super().__setstate__(state)
+
+
+class Transport:
+    """Фабрика сессий с общими настройками соединений и статистикой"""
+
+    def __init__(self, pool_size=10, connect_retries=2, backoff=0.5, dns_ttl=300, http2=False):
+        self.pool_size = pool_size  # соединений в пуле на сайт
+        self.connect_retries = connect_retries  # повторы при ошибке установки соединения
+        self.backoff = backoff
+        self.http2 = http2  # сессии на httpx с HTTP/2, требуется pip install httpx[http2]
+        self._adapters = []  # адаптеры созданных сессий requests для подсчета соединений
+        self._clients = []  # клиенты httpx сессий HTTP/2
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.compressed = 0  # ответов со сжатием
+        self.wire_bytes = 0  # байт тела ответов по сети
+        self.body_bytes = 0  # байт тела ответов после распаковки
+        self.dns = DnsCache(dns_ttl) if dns_ttl else None  # кэш DNS сессий этого транспорта, None - без кэша
+
+    @staticmethod
+    def headers(headers):
+        """Заголовки запроса с Accept-Encoding, который можно распаковать"""
+        headers = {key: value for key, value in headers.items() if key.lower() != 'accept-encoding'}
+        headers['Accept-Encoding'] = ENCODINGS
+        return headers
+
+    def session(self):
+        """Новая сессия с настроенным транспортом"""
+        if self.http2:
+            session = Http2Session(self.pool_size)
+            with self._lock:
+                self._clients.append(session.client)
+        else:
+            session = requests.Session()
+            retry = Retry(total=self.connect_retries, connect=self.connect_retries, read=0, status=0,
+                          backoff_factor=self.backoff, raise_on_status=False)
+            options = {'pool_connections': 4, 'pool_maxsize': self.pool_size, 'max_retries': retry}
+            adapter = CachedDnsAdapter(self.dns, **options) if self.dns is not None else HTTPAdapter(**options)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            with self._lock:
+                self._adapters.append(adapter)
+        session.headers.update(self.headers({'Connection': 'keep-alive'}))
+        return session
+
+    def record(self, response):
+        # учет сжатия ответа с прочитанным телом
+        body = len(response.content)
+        wire = getattr(response, 'wire_bytes', None)
+        if wire is None:
+            try:
+                wire = response.raw.tell()  # urllib3 считает байты, полученные до распаковки
+            except Exception:
+                wire = body
+        with self._lock:
+            self.responses += 1
+            self.compressed += bool(response.headers.get('Content-Encoding'))
+            self.wire_bytes += wire or body
+            self.body_bytes += body
+
+    def _connections(self):
+        # (открыто соединений, выполнено запросов) по пулам urllib3 сессий requests
+        connections = requests_count = 0
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_count += pool.num_requests
+        return connections, requests_count
+
+    def stats(self):
+        with self._lock:
+            connections, requests_count = self._connections()
+            stats = {'responses': self.responses, 'compressed': self.compressed,
+                     'wire_mb': round(self.wire_bytes / 1024 / 1024, 2),
+                     'body_mb': round(self.body_bytes / 1024 / 1024, 2),
+                     'compression_ratio': round(self.body_bytes / self.wire_bytes, 2) if self.wire_bytes else 0}
+        if self.http2:
+            stats['http2'] = True
+        else:
+            stats.update({'connections': connections, 'requests': requests_count,
+                          'reuse_rate': round(1 - connections / requests_count, 3) if requests_count else 0})
+        if self.dns is not None:
+            stats.update({'dns_hits': self.dns.hits, 'dns_misses': self.dns.misses})
+        return stats
+
+    def close(self):
+        # закрывает соединения клиентов HTTP/2, соединения сессий requests закрываются вместе с сессиями
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            client.close()
+
+
+class Http2Session:
+    """
+    Сессия на httpx с HTTP/2 и тем интерфейсом requests.Session, который использует парсер:
+    get(url, headers, timeout), cookies (RequestsCookieJar) и headers
+    """
+
+    def __init__(self, pool_size=10):
+        import httpx  # необязательная зависимость, нужна только при http2=True
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.headers = requests.structures.CaseInsensitiveDict()
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        # клиент хранит Cookies в том же объекте self.cookies
+        self.client = httpx.Client(http2=True, limits=limits, follow_redirects=True, cookies=self.cookies)
+
+    def get(self, url, headers=None, timeout=30, **kwargs):
+        response = self.client.get(url, headers=dict(self.headers, **(headers or {})), timeout=timeout)
+        return Http2Response(response)
+
+    def close(self):
+        self.client.close()
+
+
+class Http2Response:
+    """Ответ httpx с атрибутами ответа requests, которые использует парсер"""
+
+    def __init__(self, response):
+        self.url = str(response.url)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+        self.encoding = response.encoding
+        self.text = response.text
+        self.ok = response.is_success
+        self.http_version = response.http_version
+        self.wire_bytes = response.num_bytes_downloaded
+        self.raw = None
+
+    def __bool__(self):
+        return self.ok
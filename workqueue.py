@@ -0,0 +1,289 @@
+"""
+Очередь задач распределенного парсинга с арендой (lease).
+Координатор добавляет задачи: страницы листинга и ссылки на товары магазинов, узлы-исполнители
+арендуют задачи на lease секунд, выполняют их и возвращают результат. Если узел упал и не вернул
+результат, аренда истекает и задача снова выдается другому узлу.
+SqliteQueue хранит задачи в файле SQLite и подходит для нескольких процессов на одном компьютере,
+QueueServer и QueueClient открывают ту же очередь для узлов на других компьютерах по TCP
+"""
+import hmac
+import json
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from loguru import logger
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+COLLECTED = 'collected'
+FAILED = 'failed'
+
+LISTING = 'listing'
+PRODUCT = 'product'
+
+ANSWERS = 1024  # кол-во последних ответов сервера очереди, которые хранятся для повторных запросов
+LOOPBACK = ('127.0.0.1', 'localhost', '::1')
+
+
+class SqliteQueue:
+    """Очередь задач с арендой в файле SQLite"""
+
+    def __init__(self, path, lease=300, max_attempts=3):
+        self.path = path
+        self.lease_time = lease  # время аренды задачи узлом, секунд
+        self.max_attempts = max_attempts  # сколько раз задача выдается, прежде чем считается неудачной
+        # транзакции открываются явно, BEGIN IMMEDIATE защищает выдачу задач от гонки между процессами
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS task (
+                id INTEGER PRIMARY KEY, kind TEXT NOT NULL, shop TEXT NOT NULL, url TEXT NOT NULL,
+                count INTEGER NOT NULL, state TEXT NOT NULL, owner TEXT, expires REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0, result TEXT, UNIQUE (kind, shop, url))''')
+        self._lock = threading.Lock()
+
+    def put(self, kind, shop, items):
+        """
+        Добавляет задачи, уже существующие задачи с той же ссылкой не дублируются
+        :param items: dict ссылка - кол-во
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO task (kind, shop, url, count, state) VALUES (?, ?, ?, ?, ?)',
+                    [(kind, shop, url, count, PENDING) for url, count in items.items()])
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def lease(self, owner, limit=1):
+        """
+        Выдает узлу owner до limit свободных задач или задач с истекшей арендой.
+        Задача с истекшей арендой, уже выданная max_attempts раз, считается неудачной: страница,
+        на которой узел падает или зависает, не выдается узлам бесконечно
+        :return: список словарей id, kind, shop, url, count
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.execute(
+                    'UPDATE task SET state = ?, expires = 0 WHERE state = ? AND expires < ? AND attempts >= ?',
+                    (FAILED, LEASED, now, self.max_attempts))
+                rows = self._connection.execute(
+                    'SELECT id, kind, shop, url, count FROM task '
+                    'WHERE state = ? OR (state = ? AND expires < ?) ORDER BY id LIMIT ?',
+                    (PENDING, LEASED, now, limit)).fetchall()
+                self._connection.executemany(
+                    'UPDATE task SET state = ?, owner = ?, expires = ?, attempts = attempts + 1 WHERE id = ?',
+                    [(LEASED, owner, now + self.lease_time, row[0]) for row in rows])
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return [dict(zip(('id', 'kind', 'shop', 'url', 'count'), row)) for row in rows]
+
+    def complete(self, task_id, owner, result):
+        """
+        Сохраняет результат задачи. Результат узла, аренда которого истекла, не принимается
+        :return: True, если результат принят
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'UPDATE task SET state = ?, result = ? WHERE id = ? AND owner = ? AND state = ?',
+                (DONE, json.dumps(result, ensure_ascii=False), task_id, owner, LEASED))
+        return cursor.rowcount == 1
+
+    def release(self, task_id, owner):
+        """Возвращает задачу в очередь после ошибки, после max_attempts попыток задача считается неудачной"""
+        with self._lock:
+            self._connection.execute(
+                'UPDATE task SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, expires = 0 '
+                'WHERE id = ? AND owner = ? AND state = ?',
+                (self.max_attempts, FAILED, PENDING, task_id, owner, LEASED))
+
+    def collect(self, kind, shop):
+        """
+        Результаты выполненных задач магазина, которые еще не были получены координатором
+        :return: список (ссылка, кол-во, результат)
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute(
+                    'SELECT id, url, count, result FROM task WHERE kind = ? AND shop = ? AND state = ? ORDER BY id',
+                    (kind, shop, DONE)).fetchall()
+                self._connection.executemany('UPDATE task SET state = ?, result = NULL WHERE id = ?',
+                                             [(COLLECTED, row[0]) for row in rows])
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return [(url, count, json.loads(result)) for task_id, url, count, result in rows]
+
+    def counts(self, kind, shop):
+        """Кол-во задач магазина по состояниям"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT state, COUNT(*) FROM task WHERE kind = ? AND shop = ? GROUP BY state', (kind, shop)).fetchall()
+        return dict(rows)
+
+    def reset_shop(self, shop):
+        # новый парсинг магазина начинается с пустой очереди
+        with self._lock:
+            self._connection.execute('DELETE FROM task WHERE shop = ?', (shop,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class QueueServer(socketserver.ThreadingTCPServer):
+    """
+    Доступ к очереди по TCP для узлов на других компьютерах.
+    Протокол: одна строка JSON {"id": ..., "method": ..., "args": [...]} на запрос, одна строка JSON
+    {"result": ...} или {"error": ...} на ответ. Ответы на последние ANSWERS запросов хранятся по id:
+    запрос, повторенный клиентом после разрыва соединения, получает тот же ответ и не выполняется еще раз,
+    поэтому задача не выдается дважды и результат collect не теряется.
+    Каждый запрос содержит общий секрет token координатора и узлов, запросы с другим токеном отклоняются.
+    Без токена очередь открывается только на 127.0.0.1, иначе любой компьютер сети мог бы добавлять задачи
+    и результаты, которые попадают в Google-таблицу
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    methods = ('put', 'lease', 'complete', 'release', 'collect', 'counts')
+
+    def __init__(self, queue, address, token=None):
+        self.queue = queue
+        self.token = token
+        if token is None and address[0] not in LOOPBACK:
+            logger.warning(f'Токен очереди задач не задан, очередь открывается только на 127.0.0.1')
+            address = ('127.0.0.1', address[1])
+        self._answers = OrderedDict()  # id запроса - ответ
+        self._running = {}  # id запроса - threading.Event запроса, который выполняется сейчас
+        self._answers_lock = threading.Lock()
+        super().__init__(address, _QueueHandler)
+
+    def answer(self, request):
+        """Ответ на запрос, повторный запрос с тем же id получает сохраненный ответ"""
+        if self.token is not None and not hmac.compare_digest(str(request.get('token', '')), self.token):
+            return {'error': 'неверный токен очереди задач'}
+        request_id = request.get('id')
+        if request_id is None:
+            return self._execute(request)
+        with self._answers_lock:
+            if request_id in self._answers:
+                return self._answers[request_id]
+            event = self._running.get(request_id)
+            running = event is not None
+            if not running:
+                event = self._running[request_id] = threading.Event()
+        if running:  # повтор пришел по новому соединению, пока первый запрос еще выполняется
+            event.wait()
+            with self._answers_lock:
+                return self._answers[request_id]
+        answer = self._execute(request)
+        with self._answers_lock:
+            self._answers[request_id] = answer
+            while len(self._answers) > ANSWERS:
+                self._answers.popitem(last=False)
+            del self._running[request_id]
+        event.set()
+        return answer
+
+    def _execute(self, request):
+        try:
+            if request['method'] not in self.methods:
+                raise ValueError(f'неизвестный метод {request["method"]}')
+            return {'result': getattr(self.queue, request['method'])(*request['args'])}
+        except Exception as ex:
+            return {'error': str(ex)}
+
+    def start(self):
+        # обслуживание запросов в фоновом потоке, остановка методом shutdown()
+        thread = threading.Thread(target=self.serve_forever, name='queue-server', daemon=True)
+        thread.start()
+        logger.info(f'Очередь задач доступна узлам по адресу {self.server_address[0]}:{self.server_address[1]}')
+        return thread
+
+
+class _QueueHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                answer = self.server.answer(json.loads(line))
+            except ValueError as ex:  # строка не JSON
+                answer = {'error': str(ex)}
+            self.wfile.write(json.dumps(answer, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class QueueClient:
+    """Очередь задач на координаторе, с тем же набором методов, что и SqliteQueue"""
+
+    def __init__(self, address, timeout=60, token=None):
+        self.address = address
+        self.timeout = timeout
+        self.token = token  # общий секрет с координатором
+        self._socket = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args):
+        # повторный запрос после разрыва отправляется с тем же id, сервер не выполняет его второй раз
+        request = json.dumps({'id': uuid.uuid4().hex, 'token': self.token, 'method': method, 'args': args},
+                             ensure_ascii=False).encode('utf-8') + b'\n'
+        with self._lock:
+            for attempt in range(2):  # при разрыве соединения одно повторное подключение
+                try:
+                    if self._socket is None:
+                        self._socket = socket.create_connection(self.address, timeout=self.timeout)
+                        self._file = self._socket.makefile('rb')
+                    self._socket.sendall(request)
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError('координатор закрыл соединение')
+                    break
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise RuntimeError(f'Ошибка очереди задач на координаторе: {answer["error"]}')
+        return answer['result']
+
+    def put(self, kind, shop, items):
+        return self._call('put', kind, shop, items)
+
+    def lease(self, owner, limit=1):
+        return self._call('lease', owner, limit)
+
+    def complete(self, task_id, owner, result):
+        return self._call('complete', task_id, owner, result)
+
+    def release(self, task_id, owner):
+        return self._call('release', task_id, owner)
+
+    def collect(self, kind, shop):
+        return self._call('collect', kind, shop)
+
+    def counts(self, kind, shop):
+        return self._call('counts', kind, shop)
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._file = None